@@ -0,0 +1,431 @@
+"""
+Endpoint benchmark: seeds a database with a fixed seed and configurable
+volumes, then drives every route of src/app.py through the Flask test client
+and/or a multi-threaded HTTP server, and reports throughput, p50/p95/p99
+latency and memory per endpoint as JSON, tagged with the git commit.
+
+    $ pipenv run python benchmarks/endpoint_bench.py --output bench.json
+    $ pipenv run python benchmarks/endpoint_bench.py --preset large --reuse --mode both
+    $ pipenv run python benchmarks/endpoint_bench.py --database-url postgresql://localhost/bench
+    $ pipenv run python benchmarks/endpoint_bench.py --mode http --servers gunicorn,uvicorn --workers 2 --threads 32 --only all_,/<id>
+
+--servers gunicorn,uvicorn compares the WSGI app (gunicorn, gthread workers)
+with asgi.py (uvicorn) under the same concurrency, --threads being both the
+number of client connections and the threads of every server worker.
+
+The database is rebuilt from scratch unless --reuse is given and it already
+holds the requested volumes, so two runs with the same arguments measure the
+same data. Write routes run after the read routes and the routes that wipe a
+table (DELETE /users) run last.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+PRESETS = {
+    "small": {"users": 1000, "catalog": 10000, "favorites": 20000},
+    "medium": {"users": 10000, "catalog": 100000, "favorites": 500000},
+    "large": {"users": 10000, "catalog": 1000000, "favorites": 5000000},
+}
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(dirty)
+
+def rss_kb():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+############################################# SEED
+
+def seeded_volumes(db, models):
+    User, Planets, Characters, Starships, Favorites = models
+    return {
+        "users": db.session.query(User).count(),
+        "catalog": min(db.session.query(model).count() for model in (Planets, Characters, Starships)),
+        "favorites": db.session.query(Favorites).count(),
+    }
+
+def seed_database(db, volumes, seed):
+    # the same generator and bulk loader as `flask seed`
+    from seed import load
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    start = time.perf_counter()
+    load(db.engine, volumes, seed)
+    return time.perf_counter() - start
+
+############################################# ROUTES
+
+def build_routes(volumes, seed, token):
+    # every route of src/app.py; path and body are functions of the iteration
+    # number so writes never collide and reads hit the same rows on every run
+    from seed import PASSWORD
+    rng = random.Random(seed + 1)
+    catalog, users = volumes["catalog"], volumes["users"]
+    picks = [rng.randrange(1, catalog + 1) for _ in range(100000)]
+    auth = {"Authorization": "Bearer %s" % token}
+    run = "%d" % (time.time() * 1000)
+
+    def pick(i):
+        return picks[i % len(picks)]
+
+    def planet_body(i):
+        return {"name": "Bench planet %s-%d" % (run, i), "climate": "arid", "population": i,
+                "orbital_period": 1, "rotation_period": 1, "diameter": i}
+
+    def character_body(i):
+        return {"name": "Bench character %s-%d" % (run, i), "height": 1, "mass": 1, "hair_color": "none",
+                "eye_color": "red", "gender": "n/a", "birth_year": "0BBY"}
+
+    def starship_body(i):
+        return {"name": "Bench starship %s-%d" % (run, i), "manufacturer": "Incom", "crew": 1, "passengers": 1,
+                "consumables": "1 week", "cost_in_credits": i}
+
+    def user_body(i):
+        return {"first_name": "Bench %s-%d" % (run, i), "last_name": str(i), "email": "bench-%s-%d@bench.dev" % (run, i), "password": PASSWORD}
+
+    # favorites created by the POST routes use the ids no seeded favorite reaches
+    free = catalog - (volumes["favorites"] // 3) // users - 1
+
+    return [
+        # reads
+        ("GET /", "GET", lambda i: "/", None, None),
+        ("GET /all_users", "GET", lambda i: "/all_users", None, None),
+        ("GET /all_planets", "GET", lambda i: "/all_planets", None, None),
+        ("GET /all_characters", "GET", lambda i: "/all_characters", None, None),
+        ("GET /all_starships", "GET", lambda i: "/all_starships", None, None),
+        ("GET /all_planets filtered", "GET", lambda i: "/all_planets?climate=arid&sort=-diameter&limit=50", None, None),
+        ("GET /all_characters fields", "GET", lambda i: "/all_characters?fields=name,gender&limit=1000", None, None),
+        ("GET /all_starships stream", "GET", lambda i: "/all_starships?stream=1&manufacturer=Incom+Corporation&crew=%d" % (i % 50000), None, None),
+        ("GET /user/<id>", "GET", lambda i: "/user/%d" % (pick(i) % users + 1), None, None),
+        ("GET /planets/<id>", "GET", lambda i: "/planets/%d" % pick(i), None, None),
+        ("GET /characters/<id>", "GET", lambda i: "/characters/%d" % pick(i), None, None),
+        ("GET /starships/<id>", "GET", lambda i: "/starships/%d" % pick(i), None, None),
+        ("GET /search", "GET", lambda i: "/search?q=%s" % ("Planet 1", "star", "Character 42")[i % 3], None, None),
+        ("GET /stats/characters", "GET", lambda i: "/stats/characters", None, None),
+        ("GET /stats/planets", "GET", lambda i: "/stats/planets", None, None),
+        ("GET /stats/starships", "GET", lambda i: "/stats/starships", None, None),
+        ("GET /cache-stats", "GET", lambda i: "/cache-stats", None, None),
+        ("GET /pool-stats", "GET", lambda i: "/pool-stats", None, None),
+        ("GET /metrics", "GET", lambda i: "/metrics", None, None),
+        ("GET /user/favorites", "GET", lambda i: "/user/favorites", None, auth),
+        ("GET /favorites", "GET", lambda i: "/favorites", None, auth),
+        ("GET /favorites?expand", "GET", lambda i: "/favorites?expand=true", None, auth),
+        ("GET /valid-token", "GET", lambda i: "/valid-token", None, auth),
+        ("POST /login", "POST", lambda i: "/login", lambda i: {"email": "user%d@seed.dev" % (pick(i) % users + 1), "password": PASSWORD}, None),
+        # writes
+        ("POST /signup", "POST", lambda i: "/signup", lambda i: dict(user_body(i), first_name="Signup %s-%d" % (run, i), email="signup-%s-%d@bench.dev" % (run, i)), None),
+        ("POST /user", "POST", lambda i: "/user", user_body, None),
+        ("POST /planet", "POST", lambda i: "/planet", planet_body, None),
+        ("POST /character", "POST", lambda i: "/character", character_body, None),
+        ("POST /starship", "POST", lambda i: "/starship", starship_body, None),
+        ("POST /planets/bulk", "POST", lambda i: "/planets/bulk", lambda i: [planet_body(i * 100 + n + 10 ** 7) for n in range(100)], None),
+        ("POST /characters/bulk", "POST", lambda i: "/characters/bulk", lambda i: [character_body(i * 100 + n + 10 ** 7) for n in range(100)], None),
+        ("POST /starships/bulk", "POST", lambda i: "/starships/bulk", lambda i: [starship_body(i * 100 + n + 10 ** 7) for n in range(100)], None),
+        ("POST /favorites/planet/<id>", "POST", lambda i: "/favorites/planet/%d" % (catalog - i % free), None, auth),
+        ("POST /favorites/starship/<id>", "POST", lambda i: "/favorites/starship/%d" % (catalog - i % free), None, auth),
+        ("POST /favorites/character/<id>", "POST", lambda i: "/favorites/character/%d" % (catalog - i % free), None, auth),
+        ("PUT /user", "PUT", lambda i: "/user", lambda i: {"name": "User", "email": "user1@seed.dev", "password": PASSWORD}, None),
+        ("PUT /planet/<id>", "PUT", lambda i: "/planet/%d" % pick(i), lambda i: {"name": "Planet %d" % pick(i), "climate": "arid", "population": i}, None),
+        ("DELETE /favorites/planet/<id>", "DELETE", lambda i: "/favorites/planet/%d" % (catalog - i % free),
+         lambda i: {"user_id": 1, "planets_id": catalog - i % free}, None),
+        ("DELETE /favorites/character/<user>/<id>", "DELETE", lambda i: "/favorites/character/1/%d" % (catalog - i % free), None, None),
+        ("DELETE /favorites/<id>", "DELETE", lambda i: "/favorites/%d" % (3 * users * i + 1), None, auth),
+        ("DELETE /planet", "DELETE", lambda i: "/planet", lambda i: {"name": "Bench planet %s-%d" % (run, i)}, None),
+        ("DELETE /user", "DELETE", lambda i: "/user", lambda i: {"name": "Bench"}, None),
+        ("DELETE /users", "DELETE", lambda i: "/users", None, None),
+    ]
+
+############################################# DRIVERS
+
+def summarize(latencies, elapsed, statuses, rss_before, rss_after, peak=None):
+    latencies = sorted(latencies)
+
+    def percentile(fraction):
+        return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000, 3)
+
+    result = {
+        "requests": len(latencies),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(latencies[-1] * 1000, 3),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "rss_kb": rss_after,
+        "rss_delta_kb": rss_after - rss_before,
+    }
+    if peak is not None:
+        result["tracemalloc_peak_kb"] = peak // 1024
+    return result
+
+def run_client(app, routes, requests, warmup, trace):
+    client = app.test_client()
+    results = {}
+    for name, method, path, body, headers in routes:
+        count = 1 if method == "DELETE" and path(0) == "/users" else requests
+        for i in range(warmup if count > 1 else 0):
+            client.open(path(i), method=method, json=body(i) if body else None, headers=headers).close()
+        offset = warmup if count > 1 else 0
+
+        statuses, latencies = {}, []
+        rss_before = rss_kb()
+        if trace:
+            tracemalloc.start()
+        started = time.perf_counter()
+        for i in range(offset, offset + count):
+            start = time.perf_counter()
+            response = client.open(path(i), method=method, json=body(i) if body else None, headers=headers)
+            response.get_data()
+            latencies.append(time.perf_counter() - start)
+            response.close()
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        elapsed = time.perf_counter() - started
+        peak = None
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results[name] = summarize(latencies, elapsed, statuses, rss_before, rss_kb(), peak)
+        print("client %-40s %s" % (name, json.dumps({key: results[name][key] for key in ("throughput_rps", "p50_ms", "p99_ms", "statuses")})), file=sys.stderr)
+    return results
+
+def start_server(app):
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    # keep-alive, so the load threads measure the app rather than TCP handshakes
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# the same app behind the production servers, started as subprocesses on a
+# free port: gunicorn with gthread workers (wsgi.py) and uvicorn (asgi.py)
+SERVERS = {
+    "gunicorn": ["wsgi", "--chdir", "src", "--bind", "127.0.0.1:%(port)d", "--workers", "%(workers)d",
+                 "--worker-class", "gthread", "--threads", "%(threads)d", "--log-level", "warning"],
+    "uvicorn": ["asgi:application", "--app-dir", "src", "--host", "127.0.0.1", "--port", "%(port)d",
+                "--workers", "%(workers)d", "--no-access-log", "--log-level", "warning"],
+}
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def tree_rss_kb(pid):
+    # the server and its workers
+    total = 0
+    try:
+        with open("/proc/%d/statm" % pid) as statm:
+            total = int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+        with open("/proc/%d/task/%d/children" % (pid, pid)) as children:
+            total += sum(tree_rss_kb(int(child)) for child in children.read().split())
+    except OSError:
+        pass
+    return total
+
+def start_external(server, workers, threads):
+    port = free_port()
+    command = [sys.executable, "-m", server] + [arg % {"port": port, "workers": workers, "threads": threads} for arg in SERVERS[server]]
+    # asgi.py hands the routes without an async version to this many threads
+    process = subprocess.Popen(command, cwd=ROOT, env=dict(os.environ, ASGI_THREADS=str(threads)))
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("%s exited with %s" % (server, process.returncode))
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            connection.request("GET", "/")
+            connection.getresponse().read()
+            connection.close()
+            return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("%s didn't start listening on %d" % (server, port))
+
+def run_http(port, routes, requests, warmup, threads, label="http", rss=rss_kb):
+    results = {}
+    for name, method, path, body, headers in routes:
+        count = 1 if method == "DELETE" and path(0) == "/users" else requests
+        offset = warmup if count > 1 else 0
+        counter = itertools.count(0)
+        lock = threading.Lock()
+        statuses, latencies = {}, []
+
+        def worker():
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            own = []
+            own_statuses = {}
+            while True:
+                i = next(counter)
+                if i >= offset + count:
+                    break
+                payload = json.dumps(body(i)) if body else None
+                request_headers = dict(headers or {})
+                if payload is not None:
+                    request_headers["Content-Type"] = "application/json"
+                start = time.perf_counter()
+                connection.request(method, path(i).replace(" ", "%20"), body=payload, headers=request_headers)
+                response = connection.getresponse()
+                response.read()
+                if i >= offset:
+                    own.append(time.perf_counter() - start)
+                    own_statuses[response.status] = own_statuses.get(response.status, 0) + 1
+                if response.getheader("Connection", "").lower() == "close":
+                    connection.close()
+                    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            connection.close()
+            with lock:
+                latencies.extend(own)
+                for status, total in own_statuses.items():
+                    statuses[status] = statuses.get(status, 0) + total
+
+        rss_before = rss()
+        started = time.perf_counter()
+        pool = [threading.Thread(target=worker) for _ in range(min(threads, count))]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        results[name] = summarize(latencies, elapsed, statuses, rss_before, rss())
+        print("%-8s %-40s %s" % (label, name, json.dumps({key: results[name][key] for key in ("throughput_rps", "p50_ms", "p99_ms", "statuses")})), file=sys.stderr)
+    return results
+
+def run_server(server, app, routes, requests, warmup, threads, workers):
+    if server == "werkzeug":
+        httpd = start_server(app)
+        try:
+            return run_http(httpd.server_port, routes, requests, warmup, threads)
+        finally:
+            httpd.shutdown()
+    process, port = start_external(server, workers, threads)
+    try:
+        return run_http(port, routes, requests, warmup, threads, server, lambda: tree_rss_kb(process.pid))
+    finally:
+        process.terminate()
+        process.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--preset", choices=PRESETS, default="small")
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--catalog", type=int, help="planets, characters and starships each")
+    parser.add_argument("--favorites", type=int)
+    parser.add_argument("--database-url", help="defaults to a SQLite file in /tmp")
+    parser.add_argument("--reuse", action="store_true", help="keep the database when it already has the requested volumes")
+    parser.add_argument("--seed", type=int, default=1977)
+    parser.add_argument("--mode", choices=("client", "http", "both"), default="client")
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=8, help="concurrent connections in http mode")
+    parser.add_argument("--servers", default="werkzeug",
+                        help="comma separated servers for http mode: werkzeug (in process), gunicorn, uvicorn")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes of gunicorn/uvicorn")
+    parser.add_argument("--tracemalloc", action="store_true", help="report the allocation peak per endpoint (slower)")
+    parser.add_argument("--only", help="comma separated substrings of the endpoint names to run")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    volumes = dict(PRESETS[args.preset])
+    for key in volumes:
+        if getattr(args, key) is not None:
+            volumes[key] = getattr(args, key)
+
+    database_url = args.database_url or "sqlite:////tmp/endpoint_bench_%s_%s_%s.db" % (volumes["users"], volumes["catalog"], volumes["favorites"])
+    os.environ["DATABASE_URL"] = database_url
+    # the numbers must not depend on the environment of whoever runs them
+    for name in ("METRICS_DIR", "DATABASE_READ_URL", "QUERY_BUDGET_ENFORCE", "ENABLE_ADMIN"):
+        os.environ.pop(name, None)
+    sys.path.insert(0, os.path.join(ROOT, "src"))
+    from app import app
+    # request lines and the tracebacks of failing routes would drown the
+    # progress lines; failures still show up in the status counts
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    app.logger.setLevel(logging.CRITICAL)
+    from models import db, User, Planets, Characters, Starships, Favorites
+    from auth import create_user_token
+    from sqlalchemy import inspect
+    models = (User, Planets, Characters, Starships, Favorites)
+
+    with app.app_context():
+        seed_seconds = None
+        if not (args.reuse and inspect(db.engine).has_table("favorites") and seeded_volumes(db, models) == volumes):
+            print("seeding %s" % json.dumps(volumes), file=sys.stderr)
+            seed_seconds = round(seed_database(db, volumes, args.seed), 2)
+        token = create_user_token(1, "user1@seed.dev")
+        dialect = db.engine.dialect.name
+
+    routes = build_routes(volumes, args.seed, token)
+    if args.only:
+        wanted = args.only.split(",")
+        routes = [route for route in routes if any(part in route[0] for part in wanted)]
+
+    commit, dirty = git_commit()
+    from importlib.metadata import version
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "flask": version("flask"),
+        "sqlalchemy": version("sqlalchemy"),
+        "database": dialect,
+        "volumes": volumes,
+        "seed": args.seed,
+        "seed_seconds": seed_seconds,
+        "requests": args.requests,
+        "warmup": args.warmup,
+        "threads": args.threads,
+        "results": {},
+    }
+    # every HTTP run after the first measurement starts again from the freshly
+    # seeded data, not from what the previous run wrote and deleted
+    if args.mode in ("client", "both"):
+        report["results"]["client"] = run_client(app, routes, args.requests, args.warmup, args.tracemalloc)
+    if args.mode in ("http", "both"):
+        report["workers"] = args.workers
+        for index, server in enumerate(args.servers.split(",")):
+            if args.mode == "both" or index > 0:
+                with app.app_context():
+                    seed_database(db, volumes, args.seed)
+                routes = build_routes(volumes, args.seed, token)
+                if args.only:
+                    routes = [route for route in routes if any(part in route[0] for part in wanted)]
+            results = run_server(server, app, routes, args.requests, args.warmup, args.threads, args.workers)
+            report["results"]["http" if server == "werkzeug" else server] = results
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Micro-benchmark of the response path of /all_characters: the hand written
+serialize() + jsonify with the stdlib provider against the generated
+serializers + the orjson provider (when installed).
+
+    $ pipenv run python benchmarks/serialization_bench.py --rows 10000
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from flask import Flask, jsonify
+from flask.json.provider import DefaultJSONProvider
+from models import Characters
+from serializers import ORJSONProvider, orjson, serializer_for
+
+def make_rows(count):
+    return [
+        Characters(
+            id=index,
+            name="Character %s" % index,
+            height=150 + index % 60,
+            mass=50 + index % 80,
+            hair_color="brown",
+            eye_color="blue",
+            gender="female" if index % 2 else "male",
+            birth_year="%sBBY" % (index % 100),
+        )
+        for index in range(count)
+    ]
+
+def make_app(provider_class):
+    app = Flask(__name__)
+    app.json = provider_class(app)
+    return app
+
+def current_path(app, rows):
+    with app.app_context():
+        results = list(map(lambda item: item.serialize(), rows))
+        return jsonify({"msg": "ok", "results": results}).get_data()
+
+def fast_path(app, rows, tuples=False):
+    fields = [column.name for column in Characters.__table__.columns]
+    serialize = serializer_for(Characters, fields, tuples=tuples)
+    with app.app_context():
+        results = list(map(serialize, rows))
+        return jsonify({"msg": "ok", "results": results}).get_data()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    # what Query.with_entities() hands back on the ?fields= path
+    fields = [column.name for column in Characters.__table__.columns]
+    tuple_rows = [tuple(getattr(row, field) for field in fields) for row in rows]
+    stdlib_app = make_app(DefaultJSONProvider)
+    cases = {
+        "serialize+stdlib": lambda: current_path(stdlib_app, rows),
+        "generated+stdlib": lambda: fast_path(stdlib_app, rows),
+    }
+    if orjson is not None:
+        orjson_app = make_app(ORJSONProvider)
+        cases["generated+orjson"] = lambda: fast_path(orjson_app, rows)
+        cases["generated(tuples)+orjson"] = lambda: fast_path(orjson_app, tuple_rows, tuples=True)
+
+    # both paths must produce the same document
+    reference = json.loads(cases["serialize+stdlib"]())
+    for name, case in cases.items():
+        assert json.loads(case()) == reference, name
+
+    report = {"rows": args.rows, "orjson": orjson is not None, "results": {}}
+    for name, case in cases.items():
+        best = min(timeit.repeat(case, number=1, repeat=args.repeat))
+        report["results"][name] = {"seconds": round(best, 6), "rows_per_second": round(args.rows / best)}
+    baseline = report["results"]["serialize+stdlib"]["seconds"]
+    for result in report["results"].values():
+        result["speedup"] = round(baseline / result["seconds"], 2)
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
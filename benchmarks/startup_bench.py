@@ -0,0 +1,91 @@
+"""
+Startup time report: imports src/app.py in fresh interpreters with
+`python -X importtime` and reports the wall time, the cumulative import time
+of `app` and the heaviest modules, as JSON.
+
+    $ pipenv run python benchmarks/startup_bench.py --runs 5 > startup.json
+    $ pipenv run python benchmarks/startup_bench.py --baseline startup.json
+
+With --baseline the script exits with 1 when the import time of `app` grew
+more than --max-regression (20% by default) over the saved report.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+def parse_importtime(stderr):
+    # "import time: self [us] | cumulative | imported package"
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append({
+            "module": name.strip(),
+            "depth": depth,
+            "self_us": int(self_us),
+            "cumulative_us": int(cumulative_us),
+        })
+    return modules
+
+def run_once(env):
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=SRC, env=env, capture_output=True, text=True, check=True,
+    )
+    return time.perf_counter() - start, parse_importtime(process.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--baseline")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URL", "sqlite:////tmp/startup_bench.db")
+
+    walls, app_times, runs = [], [], []
+    for _ in range(args.runs):
+        wall, modules = run_once(env)
+        walls.append(wall)
+        app_times.append(next(module["cumulative_us"] for module in modules if module["module"] == "app"))
+        runs.append(modules)
+
+    # the heaviest direct imports of the median run
+    median_run = runs[app_times.index(sorted(app_times)[len(app_times) // 2])]
+    app_depth = next(module["depth"] for module in median_run if module["module"] == "app")
+    direct = [module for module in median_run if module["depth"] == app_depth + 1]
+    heaviest = sorted(direct, key=lambda module: module["cumulative_us"], reverse=True)[:args.top]
+
+    report = {
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "wall_seconds_median": round(statistics.median(walls), 4),
+        "app_import_us_median": int(statistics.median(app_times)),
+        "app_import_us_min": min(app_times),
+        "heaviest_imports": [
+            {"module": module["module"], "cumulative_us": module["cumulative_us"]} for module in heaviest
+        ],
+    }
+    print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        allowed = baseline["app_import_us_median"] * (1 + args.max_regression)
+        if report["app_import_us_median"] > allowed:
+            print("startup regression: %s us > %s us allowed" % (report["app_import_us_median"], int(allowed)), file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,29 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
+import click
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate
-from flask_swagger import swagger
 from flask_cors import CORS
-from utils import APIException, generate_sitemap
-from admin import setup_admin
+from utils import APIException, generate_sitemap, paginate, wants_stream, stream_ndjson, flag_arg, get_fields, select_fields
 from models import db, User, Planets, Characters, Starships, Favorites
-from flask_jwt_extended import create_access_token
-from flask_jwt_extended import get_jwt_identity
-from flask_jwt_extended import jwt_required
+from changes import setup_change_tracking, on_commit
+from shared_cache import make_cache_store, make_entity_cache
+from versions import setup_table_versions, etag_by_version
+from bulk import bulk_create, bulk_query_budget
+from batch import batch_get, batch_query_budget
+from budget import query_budget
+from serializers import serializer_for, setup_json
+from compression import compressed
+from filters import apply_filters, get_sort, is_filtered
+from search import NameIndex, search_query_budget
+from pool import engine_options_from_env, pool_stats
+from metrics import metrics, setup_metrics, render_metrics, cache_samples, pool_samples
+from replicas import replica_binds, setup_replicas, read_only, mark_write
+from stats import STATS, stats_cache, setup_stats_cache, get_stats
+from auth import setup_identity_cache, create_user_token, get_current_user_id
+from flask_jwt_extended import jwt_required, get_jwt_identity
 from flask_jwt_extended import JWTManager
 #from models import Person
 
@@ -24,14 +37,120 @@ if db_url is not None:
 else:
     app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options_from_env(app.config['SQLALCHEMY_DATABASE_URI'])
+# replicas de solo lectura opcionales, separadas por comas
+db_read_url = os.getenv("DATABASE_READ_URL")
+if db_read_url:
+    app.config['SQLALCHEMY_BINDS'] = replica_binds(db_read_url.split(","), engine_options_from_env)
+app.config['REPLICA_STICKY_SECONDS'] = int(os.getenv("REPLICA_STICKY_SECONDS", 5))
+app.config['PAGE_DEFAULT_LIMIT'] = int(os.getenv("PAGE_DEFAULT_LIMIT", 100))
+app.config['PAGE_MAX_LIMIT'] = int(os.getenv("PAGE_MAX_LIMIT", 1000))
+app.config['STREAM_BATCH_SIZE'] = int(os.getenv("STREAM_BATCH_SIZE", 1000))
+app.config['ENTITY_CACHE_SIZE'] = int(os.getenv("ENTITY_CACHE_SIZE", 10000))
+app.config['ENTITY_CACHE_TTL'] = int(os.getenv("ENTITY_CACHE_TTL", 300))
+# memory (uno por worker), shm (compartido por los workers de la maquina) o redis
+app.config['CACHE_BACKEND'] = os.getenv("CACHE_BACKEND", "memory")
+app.config['CACHE_SHM_PATH'] = os.getenv("CACHE_SHM_PATH")
+app.config['CACHE_SHM_SLOTS'] = int(os.getenv("CACHE_SHM_SLOTS", 16384))
+app.config['CACHE_SHM_SLOT_SIZE'] = int(os.getenv("CACHE_SHM_SLOT_SIZE", 1024))
+app.config['CACHE_REDIS_URL'] = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+# prefijo de las claves compartidas, por defecto un hash de la URL de la base de datos
+app.config['CACHE_NAMESPACE'] = os.getenv("CACHE_NAMESPACE")
+app.config['IDENTITY_CACHE_SIZE'] = int(os.getenv("IDENTITY_CACHE_SIZE", 10000))
+app.config['IDENTITY_CACHE_TTL'] = int(os.getenv("IDENTITY_CACHE_TTL", 60))
+app.config['BULK_MAX_ITEMS'] = int(os.getenv("BULK_MAX_ITEMS", 100000))
+app.config['BULK_CHUNK_SIZE'] = int(os.getenv("BULK_CHUNK_SIZE", 1000))
+app.config['BATCH_MAX_IDS'] = int(os.getenv("BATCH_MAX_IDS", 1000))
+app.config['BATCH_CHUNK_SIZE'] = int(os.getenv("BATCH_CHUNK_SIZE", 500))
+# emails (separados por comas) de los usuarios que pueden pedir usuarios en lote
+app.config['ADMIN_EMAILS'] = [email.strip() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()]
+app.config['JSON_BACKEND'] = os.getenv("JSON_BACKEND", "orjson")
+app.config['COMPRESS_ENABLED'] = os.getenv("COMPRESS_ENABLED", "1") == "1"
+app.config['COMPRESS_ALGORITHMS'] = os.getenv("COMPRESS_ALGORITHMS", "zstd,br,gzip").split(",")
+app.config['COMPRESS_MIN_SIZE'] = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+app.config['COMPRESS_LEVEL'] = int(os.getenv("COMPRESS_LEVEL", 6))
+app.config['COMPRESS_BROTLI_LEVEL'] = int(os.getenv("COMPRESS_BROTLI_LEVEL", 4))
+app.config['COMPRESS_ZSTD_LEVEL'] = int(os.getenv("COMPRESS_ZSTD_LEVEL", 3))
+app.config['SEARCH_DEFAULT_LIMIT'] = int(os.getenv("SEARCH_DEFAULT_LIMIT", 10))
+app.config['SEARCH_MAX_LIMIT'] = int(os.getenv("SEARCH_MAX_LIMIT", 50))
+app.config['SEARCH_SCAN_LIMIT'] = int(os.getenv("SEARCH_SCAN_LIMIT", 2000))
+app.config['SEARCH_REBUILD_SECONDS'] = int(os.getenv("SEARCH_REBUILD_SECONDS", 300))
+app.config['SEARCH_OVERLAY_LIMIT'] = int(os.getenv("SEARCH_OVERLAY_LIMIT", 10000))
+app.config['STATS_CACHE_SIZE'] = int(os.getenv("STATS_CACHE_SIZE", 100))
+app.config['STATS_CACHE_TTL'] = int(os.getenv("STATS_CACHE_TTL", 3600))
+app.config['METRICS_DIR'] = os.getenv("METRICS_DIR")
+app.config['METRICS_FLUSH_SECONDS'] = int(os.getenv("METRICS_FLUSH_SECONDS", 5))
+app.config['QUERY_BUDGET_ENFORCE'] = os.getenv("QUERY_BUDGET_ENFORCE", "0") == "1"
+# hilos con los que asgi.py sirve las rutas que no tienen version async
+app.config['ASGI_THREADS'] = int(os.getenv("ASGI_THREADS", 16))
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=3000, debug=True)
 
-MIGRATE = Migrate(app, db)
+# Flask-Migrate (y con ella todo alembic) solo hace falta en los comandos `flask db ...`,
+# los workers de gunicorn no lo importan
+if click.get_current_context(silent=True) is not None:
+    from flask_migrate import Migrate
+    MIGRATE = Migrate(app, db)
+    # `flask seed`: datos sinteticos en bloque para pruebas de carga
+    from seed import setup_seed_command
+    setup_seed_command(app)
 db.init_app(app)
 CORS(app)
-setup_admin(app)
+setup_json(app)
+
+# el admin es opcional (ENABLE_ADMIN=1), cargarlo cuesta casi tanto como el resto de la app
+if os.getenv("ENABLE_ADMIN", "0") == "1":
+    from admin import setup_admin
+    setup_admin(app)
+setup_change_tracking(db)
+setup_table_versions(db)
+
+# almacen compartido por los workers con CACHE_BACKEND=shm/redis (None con memory)
+cache_store = make_cache_store(app.config)
+
+# los GET marcados con @read_only leen de las replicas, quien acaba de escribir
+# sigue leyendo del primario unos segundos para ver sus propios cambios (por la
+# cookie o por la identidad de su token)
+setup_replicas(app, cache_store)
+on_commit(mark_write)
+
+# cache de los get_one_*, se invalida sola con cada commit que toque esas filas;
+# con CACHE_BACKEND=shm/redis planetas, personajes y naves se comparten entre workers; los
+# usuarios (llevan el password) se quedan en cada worker y solo se comparte su invalidacion
+entity_cache = make_entity_cache(cache_store, (Planets, Characters, Starships),
+                                 app.config['ENTITY_CACHE_SIZE'], app.config['ENTITY_CACHE_TTL'],
+                                 private_models=(User,))
+on_commit(entity_cache.invalidate_touched)
+
+# identidades ya verificadas de los tokens, borrar o cambiar un usuario las revoca
+# (en todos los workers si la cache es compartida)
+identity_cache = setup_identity_cache(app, cache_store)
+on_commit(identity_cache.invalidate_touched)
+
+# indice de nombres para /search, lo construye el master de gunicorn antes de crear los
+# workers (que lo comparten) o, sin gunicorn, la primera busqueda
+name_index = NameIndex({"character": Characters, "planet": Planets, "starship": Starships})
+name_index.scan_limit = app.config['SEARCH_SCAN_LIMIT']
+name_index.rebuild_seconds = app.config['SEARCH_REBUILD_SECONDS']
+name_index.overlay_limit = app.config['SEARCH_OVERLAY_LIMIT']
+on_commit(name_index.mark_touched)
+
+# agregados de /stats, una entrada por version de tabla
+setup_stats_cache(app)
+on_commit(stats_cache.invalidate_models)
+
+# latencias, codigos de respuesta y queries por endpoint, servidas en /metrics
+setup_metrics(app)
+
+@metrics.register_collector
+def collect_cache_and_pool_metrics():
+    for name, cache in (("entity", entity_cache), ("identity", identity_cache), ("stats", stats_cache)):
+        yield from cache_samples(name, cache.stats())
+    # tambien se llama al salir del worker, fuera de cualquier request
+    with app.app_context():
+        engines = db.engines
+    yield from pool_samples(pool_stats(engines))
 
 # Handle/serialize errors like a JSON object
 @app.errorhandler(APIException)
@@ -40,10 +159,13 @@ def handle_invalid_usage(error):
 
 # generate sitemap with all your endpoints
 @app.route('/')
+@query_budget(0)
 def sitemap():
     return generate_sitemap(app)
 
                                          ########DEFINIMOS NUESTROS ENDPOINTS############
+# cada endpoint declara cuantas queries puede hacer con @query_budget(n); en debug/testing pasarse
+# (o repetir la misma query) es un error, en produccion solo queda en el log
 #########################################################################################################################################
 
 
@@ -51,66 +173,107 @@ def sitemap():
 
 #OBTENER TODOS LOS USUARIOS: 
 @app.route('/all_users', methods=['GET'])
+@query_budget(2)
+@read_only
+@compressed
+@etag_by_version(User)
 def get_all_users():
-    query_results = User.query.all()
-    results = list(map(lambda item: item.serialize(), query_results))
+    sort = get_sort(User)
+    if wants_stream():
+        return stream_ndjson(User.query, sort, serializer_for(User))
 
-    if results == []:
+    query_results, next_cursor = paginate(User.query, sort)
+    results = list(map(serializer_for(User), query_results))
+
+    if results == [] and request.args.get("after") is None:
         return jsonify("no users in the database"), 404
     
     response_body = {
         "msg": "ok",
-        "results": results
+        "results": results,
+        "next_cursor": next_cursor
     }
     
     return jsonify(response_body), 200
 
 #OBTENER TODOS LOS PLANETAS
 @app.route('/all_planets', methods=['GET'])
+@query_budget(2)
+@read_only
+@compressed
+@etag_by_version(Planets)
 def get_all_planets():
-    query_results = Planets.query.all()
-    results = list(map(lambda item: item.serialize(), query_results))
+    sort = get_sort(Planets)
+    query, serialize = select_fields(Planets, sort)
+    query = apply_filters(query, Planets)
+    if wants_stream():
+        return stream_ndjson(query, sort, serialize)
+
+    query_results, next_cursor = paginate(query, sort)
+    results = list(map(serialize, query_results))
 
-    if results == []:
+    if results == [] and request.args.get("after") is None and not is_filtered():
         return jsonify("no planets in the database"), 404
     
     response_body = {
         "msg": "ok",
-        "results": results
+        "results": results,
+        "next_cursor": next_cursor
     }
     
     return jsonify(response_body), 200
 
 #OBTENER TODOS LOS PERSONAJES:
 @app.route('/all_characters', methods=['GET'])
+@query_budget(2)
+@read_only
+@compressed
+@etag_by_version(Characters)
 def get_all_characters():
-    query_results = Characters.query.all()
-    result_id = [item.id for item in query_results]
-    results = list(map(lambda item: item.serialize(), query_results))
+    sort = get_sort(Characters)
+    query, serialize = select_fields(Characters, sort)
+    query = apply_filters(query, Characters)
+    if wants_stream():
+        return stream_ndjson(query, sort, serialize)
+
+    query_results, next_cursor = paginate(query, sort)
+    results = list(map(serialize, query_results))
 
-    if results == []:
+    if results == [] and request.args.get("after") is None and not is_filtered():
         return jsonify("no characters in the database"), 404
     
     response_body = {
         
         "msg": "ok",
-        "results": results
+        "results": results,
+        "next_cursor": next_cursor
     }
     
     return jsonify(response_body), 200
 
 #OBTENER TODAS LAS NAVES ESPACIALES: 
 @app.route('/all_starships', methods=['GET'])
+@query_budget(2)
+@read_only
+@compressed
+@etag_by_version(Starships)
 def get_all_starships():
-    query_results = Starships.query.all()
-    results = list(map(lambda item: item.serialize(), query_results))
+    sort = get_sort(Starships)
+    query, serialize = select_fields(Starships, sort)
+    query = apply_filters(query, Starships)
+    if wants_stream():
+        return stream_ndjson(query, sort, serialize)
 
-    if results == []:
+    query_results, next_cursor = paginate(query, sort)
+    results = list(map(serialize, query_results))
+
+    if results == [] and request.args.get("after") is None and not is_filtered():
         return jsonify("no starships in the database"), 404
     
     response_body = {
         "msg": "ok",
-        "results": results
+        "results": results,
+        "next_cursor": next_cursor
     }
     
     return jsonify(response_body), 200
@@ -120,8 +283,10 @@ def get_all_starships():
 
 #OBTENER UN USUARIO CONCRETO USANDO SU ID CON URL DINAMICA
 @app.route('/user/<int:user_id>', methods=['GET'])
+@query_budget(1)
+@read_only
 def get_one_user(user_id):
-    query_results = User.query.filter_by(id=user_id).first()
+    query_results = entity_cache.get_or_load(User, user_id)
    
 
     if query_results is None:
@@ -129,28 +294,32 @@ def get_one_user(user_id):
     
     response_body = {
         "msg": "ok",
-        "results": query_results.serialize()
+        "results": query_results
     }
     return jsonify(response_body), 200
 
 #OBTENER UNA NAVE ESPACIAL CONCRETA USANDO SU ID CON URL DINAMICA
 @app.route('/starships/<int:starship_id>', methods=['GET'])
+@query_budget(1)
+@read_only
 def get_one_starship(starship_id):
-    query_result = Starships.query.filter_by(id=starship_id).first()
+    query_result = entity_cache.get_or_load(Starships, starship_id, get_fields(Starships))
 
     if query_result is None:
          return jsonify({"msg": "there is no starship matching the Name provided"}), 404
     
     response_body = {
         "msg": "ok",
-        "results": query_result.serialize()
+        "results": query_result
     }
     return jsonify(response_body), 200
 
 #OBTENER UN PLANETA CONCRETO USANDO URL DINAMICA (cambiamos int por string)
 @app.route('/planets/<int:planet_id>', methods=['GET'])
+@query_budget(1)
+@read_only
 def get_one_planet(planet_id):
-    query_result = Planets.query.filter_by(id=planet_id).first()
+    query_result = entity_cache.get_or_load(Planets, planet_id, get_fields(Planets))
    
 
     if query_result is None:
@@ -158,7 +327,7 @@ def get_one_planet(planet_id):
     
     response_body = {
         "msg": "ok",
-        "results": query_result.serialize()
+        "results": query_result
     }
     return jsonify(response_body), 200
 
@@ -166,42 +335,141 @@ def get_one_planet(planet_id):
 
 #OBTENER UN PERSONAJE CONCRETO USANDO URL DINAMICA
 @app.route('/characters/<int:character_id>', methods=['GET'])
+@query_budget(1)
+@read_only
 def get_one_character(character_id):
 
-    query_result = Characters.query.filter_by(id=character_id).first()
-    print(query_result)
+    query_result = entity_cache.get_or_load(Characters, character_id, get_fields(Characters))
     if query_result is None:
         return jsonify({"msg": "there is no character matching the name provided"}), 404
     
     response_body = {
         "msg": "ok",
-        "id": query_result.id,
-        "results": query_result.serialize()
+        "id": query_result["id"],
+        "results": query_result
     }
     return jsonify(response_body), 200
 
 
+#########ENDPOINTS PARA OBTENER VARIOS REGISTROS POR SUS IDS (?ids=1,2,3 o POST {"ids": [1, 2, 3]}):
+# los que estan en la cache no van a la base de datos, el resto sale de un solo
+# WHERE id IN (...) por cada BATCH_CHUNK_SIZE ids; se devuelven en el orden pedido
+# y los que no existen en "missing"
+
+#OBTENER VARIOS PLANETAS
+@app.route('/planets', methods=['GET', 'POST'])
+@query_budget(batch_query_budget)
+@read_only
+@compressed
+def get_many_planets():
+    return jsonify(batch_get(entity_cache, Planets, get_fields(Planets))), 200
+
+#OBTENER VARIOS PERSONAJES
+@app.route('/characters', methods=['GET', 'POST'])
+@query_budget(batch_query_budget)
+@read_only
+@compressed
+def get_many_characters():
+    return jsonify(batch_get(entity_cache, Characters, get_fields(Characters))), 200
+
+#OBTENER VARIAS NAVES ESPACIALES
+@app.route('/starships', methods=['GET', 'POST'])
+@query_budget(batch_query_budget)
+@read_only
+@compressed
+def get_many_starships():
+    return jsonify(batch_get(entity_cache, Starships, get_fields(Starships))), 200
+
+#OBTENER VARIOS USUARIOS (solo los de ADMIN_EMAILS)
+@app.route('/users', methods=['GET', 'POST'])
+@query_budget(lambda: batch_query_budget() + 1)
+@read_only
+@compressed
+@jwt_required()
+def get_many_users():
+    if get_current_user_id() is None or get_jwt_identity() not in app.config['ADMIN_EMAILS']:
+        return jsonify({"msg": "only admins can list users"}), 403
+    return jsonify(batch_get(entity_cache, User)), 200
+
+
+#BUSCAR PERSONAJES, PLANETAS Y NAVES POR NOMBRE (exactos, luego prefijos, luego subcadenas)
+# (con el indice al dia ninguna query, las de construirlo o recargar filas se suman aparte)
+@app.route('/search', methods=['GET'])
+@query_budget(search_query_budget)
+@read_only
+def search():
+    q = request.args.get("q", "").strip()
+    if q == "":
+        raise APIException("q is required", status_code=400)
+    limit = request.args.get("limit", app.config['SEARCH_DEFAULT_LIMIT'], type=int)
+    limit = max(1, min(limit, app.config['SEARCH_MAX_LIMIT']))
+
+    return jsonify({"msg": "ok", "results": name_index.search(q, limit)}), 200
+
+#ESTADISTICAS DE PERSONAJES, PLANETAS Y NAVES (GROUP BY en la base de datos, cacheadas)
+@app.route('/stats/<string:entity>', methods=['GET'])
+@query_budget(4)
+@read_only
+def get_entity_stats(entity):
+    if entity not in STATS:
+        return jsonify({"msg": "there are no stats for %s" % entity}), 404
+
+    return jsonify({"msg": "ok", "results": get_stats(entity)}), 200
+
+#ESTADISTICAS DE LA CACHE DE ENTIDADES (aciertos, fallos y desalojos)
+@app.route('/cache-stats', methods=['GET'])
+@query_budget(0)
+def get_cache_stats():
+    return jsonify({"msg": "ok", "results": entity_cache.stats()}), 200
+
+
+#METRICAS EN FORMATO PROMETHEUS (sumando todos los workers si hay METRICS_DIR)
+@app.route('/metrics', methods=['GET'])
+@query_budget(0)
+def get_metrics():
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+#ESTADO DEL POOL DE CONEXIONES (conexiones en uso, overflow y espera al pedir una)
+@app.route('/pool-stats', methods=['GET'])
+@query_budget(0)
+def get_pool_stats():
+    return jsonify({"msg": "ok", "results": pool_stats(db.engines)}), 200
+
+
 ####### OBTENER TODOS LOS FAVORITOS DE UN USUARIO ######
+
+# con ?expand=true devolvemos las entidades completas, cargadas con un SELECT ... IN
+# por relacion (3 queries en total) en vez de una peticion por favorito desde el cliente
+def get_favorites_of_user(user_id):
+    query = Favorites.query.filter_by(user_id=user_id)
+    if flag_arg("expand"):
+        query = query.options(
+            selectinload(Favorites.character),
+            selectinload(Favorites.planet),
+            selectinload(Favorites.starship)
+        )
+        return query.all(), Favorites.serialize_expanded
+    return query.all(), serializer_for(Favorites, ["id", "characters_id", "planets_id", "starships_id"])
+
 @app.route('/user/favorites', methods=['GET'])
+@query_budget(5)
+@read_only
+@compressed
 @jwt_required()
 def get_all_favorites_of_user():
-    email = get_jwt_identity()
+    user_id = get_current_user_id()
 
-    user_exists = User.query.filter_by(email=email).first()
-
-    if user_exists is None: 
+    if user_id is None: 
            return jsonify({"msg": "This user does not exist"}), 401
 
-    user_id = user_exists.id
-
-    query_results = Favorites.query.filter_by(user_id=user_id).all()
+    query_results, serialize = get_favorites_of_user(user_id)
 
     # planet_exists = Planets.query.filter_by(id=planet_id).first()
     
 
     if query_results:
-        results = list(map(lambda item: item.serialize(), query_results))
-        print(results)
+        results = list(map(serialize, query_results))
         return jsonify({"msg": "ok", "results": results}), 200
     
     else: 
@@ -246,6 +514,7 @@ def get_all_favorites_of_user():
 #CREAR UN USUARIO
 
 @app.route('/user', methods=['POST'])
+@query_budget(3)
 def add_new_user():
     data = request.json
 
@@ -270,6 +539,7 @@ def add_new_user():
 
 #CREAR UN PLANETA NUEVO
 @app.route('/planet', methods=['POST'])
+@query_budget(3)
 def add_new_planet():
     data = request.json
     print(data)
@@ -298,6 +568,7 @@ def add_new_planet():
 
 #CREAR UNA NAVE ESPACIAL NUEVA
 @app.route('/starship', methods=['POST'])
+@query_budget(3)
 def add_new_starship():
     data = request.json
     print(data)
@@ -326,6 +597,7 @@ def add_new_starship():
 
 #CREAR UN PERSONAJE NUEVO
 @app.route('/character', methods=['POST'])
+@query_budget(3)
 def add_new_character():
     data = request.json
     print(data)
@@ -352,46 +624,56 @@ def add_new_character():
     else:
             return ({"msg": "this character is already included in the database"}), 200
 
+#CREAR PLANETAS, PERSONAJES Y NAVES EN BLOQUE (array JSON o NDJSON, una sola transaccion)
+@app.route('/planets/bulk', methods=['POST'])
+@query_budget(bulk_query_budget)
+def add_new_planets_bulk():
+    return jsonify(bulk_create(Planets)), 200
+
+@app.route('/characters/bulk', methods=['POST'])
+@query_budget(bulk_query_budget)
+def add_new_characters_bulk():
+    return jsonify(bulk_create(Characters)), 200
+
+@app.route('/starships/bulk', methods=['POST'])
+@query_budget(bulk_query_budget)
+def add_new_starships_bulk():
+    return jsonify(bulk_create(Starships)), 200
+
 ################# AÑADIR FAVORITOS PARA USUARIOS ################################
 
 # AÑADIR PLANETA FAVORITO USANDO IDs EN LA URL DINAMICA 
 @app.route('/favorites/planet/<int:planet_id>', methods=['POST'])
+@query_budget(4)
 @jwt_required()
 def add_new_favorite_planet(planet_id):
 
-    email = get_jwt_identity()
-  
-
-    user_exists = User.query.filter_by(email=email).first()
+    user_id = get_current_user_id()
 
-    if user_exists is None: 
+    if user_id is None: 
            return jsonify({"msg": "This user does not exist"}), 401
 
-    user_id = user_exists.id
-
     planet_exists = Planets.query.filter_by(id=planet_id).first()
     
     if planet_exists is None: 
            return jsonify({"msg": "This fucking planet does not exist"}), 401
     
     
-    query_results = Favorites.query.filter_by(planets_id=planet_id, user_id=user_id).first()
-    print(query_results)
-    if query_results is None: 
-
-            new_favorite = Favorites(planets_id=planet_id, user_id=user_id)
-            new_planet = Planets.query.filter_by(id=planet_id).first()
-            db.session.add(new_favorite)
+    # el indice unico (user_id, planets_id) detecta el duplicado, sin SELECT previo
+    results = planet_exists.serialize()
+    new_favorite = Favorites(planets_id=planet_id, user_id=user_id)
+    db.session.add(new_favorite)
+    try:
             db.session.commit()
-
-            response_body = {
-                 "msg": "ok", 
-                 "results": new_planet.serialize()
-            }
-            return jsonify(response_body), 200 
-
-    else:
+    except IntegrityError:
+            db.session.rollback()
             return ({"msg": "this user already has this planet as a favorite"}), 200
+
+    response_body = {
+         "msg": "ok", 
+         "results": results
+    }
+    return jsonify(response_body), 200 
         
   
     
@@ -457,72 +739,61 @@ def add_new_favorite_planet(planet_id):
 
 # AÑADIR NAVE ESPACIAL FAVORITA USANDO IDs EN LA URL DINAMICA 
 @app.route('/favorites/starship/<int:starship_id>', methods=['POST'])
+@query_budget(4)
 @jwt_required()
 def add_new_favorite_starship(starship_id):
 
-    email = get_jwt_identity()
+    user_id = get_current_user_id()
 
-    user_exists = User.query.filter_by(email=email).first()
-
-    if user_exists is None: 
+    if user_id is None: 
            return jsonify({"msg": "This user does not exist"}), 401
 
-    user_id = user_exists.id
-
     starships_exists = Starships.query.filter_by(id=starship_id).first()
 
     if starships_exists is None: 
            return jsonify({"msg": "This starship does not exist"}), 401
     
 
-    query_results = Favorites.query.filter_by(starships_id=starship_id, user_id=user_id).first()
-
-    if query_results is None: 
-
-            new_favorite = Favorites(starships_id=starship_id, user_id=user_id)
-            new_starship = Starships.query.filter_by(id=starship_id).first()
-            db.session.add(new_favorite)
+    results = starships_exists.serialize()
+    new_favorite = Favorites(starships_id=starship_id, user_id=user_id)
+    db.session.add(new_favorite)
+    try:
             db.session.commit()
-
-            response_body = {
-                 "msg": "ok", 
-                 "results": new_starship.serialize()
-            }
-            return jsonify(response_body), 200 
-
-    else:
+    except IntegrityError:
+            db.session.rollback()
             return ({"msg": "this user already has this starship as a favorite"}), 200
+
+    response_body = {
+         "msg": "ok", 
+         "results": results
+    }
+    return jsonify(response_body), 200 
     
 #AÑADIR PERSONAJE FAVORITO (usando request.json: el cliente nos tiene que enviar ambos IDs en el body)
 @app.route('/favorites/character/<int:character_id>', methods=['POST'])
+@query_budget(4)
 @jwt_required()
 def add_new_favorite_character(character_id):
-    email = get_jwt_identity()
-    
-    user_exists = User.query.filter_by(email=email).first()
+    user_id = get_current_user_id()
 
-    if user_exists is None:
+    if user_id is None:
          return jsonify({"msg": "this user does not exist"}), 401
-    
-    user_id = user_exists.id
 
     characters_exists = Characters.query.filter_by(id=character_id).first()
     
     if characters_exists is None:
          return jsonify({"msg": "this character does not exist"}), 401
    
-    query_results = Favorites.query.filter_by(characters_id=character_id, user_id=user_id).first()
-
-    if query_results is None: 
-
-            new_favorite = Favorites(characters_id=character_id, user_id=user_id)
-            new_character = Characters.query.filter_by(id=character_id).first()
-            db.session.add(new_favorite)
+    results = characters_exists.serialize()
+    new_favorite = Favorites(characters_id=character_id, user_id=user_id)
+    db.session.add(new_favorite)
+    try:
             db.session.commit()
-            return ({"msg": "ok", "results": new_character.serialize()}), 200
-
-    else:
+    except IntegrityError:
+            db.session.rollback()
             return ({"msg": "this user already has this character as a favorite"}), 200
+
+    return ({"msg": "ok", "results": results}), 200
         
 
 
@@ -530,6 +801,7 @@ def add_new_favorite_character(character_id):
     
 #ACTUALIZAR USUARIO (USANDO SU NOMBRE COMO COINCIDENCIA DENTRO DEL BODY)    
 @app.route('/user', methods=['PUT'])
+@query_budget(3)
 def update_user():
     data = request.json
 
@@ -554,6 +826,7 @@ def update_user():
  
 # ACTUALIZAR DATOS DE UN PLANETA USANDO URL DINAMICA E ID DEL PLANETA
 @app.route('/planet/<int:planet_id>', methods=['PUT'])
+@query_budget(3)
 def update_planet(planet_id):
     data = request.json
 
@@ -581,6 +854,7 @@ def update_planet(planet_id):
 
 # BORRAR USUARIO EN BASE A SU NOMBRE        
 @app.route('/user', methods=['DELETE'])
+@query_budget(4)
 def delete_user():
     data = request.json
 
@@ -601,6 +875,7 @@ def delete_user():
 
 # BORRAR TODOS LOS USUARIOS       
 @app.route('/users', methods=['DELETE'])
+@query_budget(2)
 def delete_all_users():
     users_deleted = User.query.delete()
     db.session.commit()
@@ -617,6 +892,7 @@ def delete_all_users():
     
 # 1 #PRIMER MÉTODO, USANDO EL REQUEST.JSON PARA SABER IDS DE USUARIO Y PLANETA
 @app.route('/favorites/planet/<int:planets_id>', methods=['DELETE'])
+@query_budget(5)
 def delete_favorite_planet(planets_id):
     data = request.json
 
@@ -643,6 +919,7 @@ def delete_favorite_planet(planets_id):
 
 # 2 # SEGUNDO MÉTODO, USANDO LA URL DINÁMICA PARA SABER IDS DE USUARIO Y PLANETA (METODO OPTIMO)        
 @app.route('/favorites/character/<int:user_id>/<int:characters_id>', methods=['DELETE'])
+@query_budget(5)
 def delete_favorite_character(user_id,characters_id):
    
 
@@ -668,26 +945,21 @@ def delete_favorite_character(user_id,characters_id):
        
 #BORRAR UN FAVORITO USANDO EL ID DEL FAVORITO @@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@    
 @app.route('/favorites/<int:favorite_id>', methods=['DELETE'])
+@query_budget(4)
 @jwt_required()
 def delete_favorite(favorite_id):
-    email = get_jwt_identity()
-
-    user_exists = User.query.filter_by(email=email).first()
-    if user_exists is None: 
+    user_id = get_current_user_id()
+    if user_id is None: 
             return jsonify({"msg": "this user does not exist"})
-    
-    user_id = user_exists.id
 
-    favorite_exists = Favorites.query.filter_by(id=favorite_id).first()
+    # una sola query: si existe pero es de otro usuario no hay nada que borrar
+    favorite_exists = db.session.get(Favorites, favorite_id)
     if favorite_exists is None: 
             return jsonify({"msg": "this favorite does not exist"})
-    
-
-    query_results = Favorites.query.filter_by(id=favorite_id, user_id=user_id).first()
 
-    if query_results: 
+    if favorite_exists.user_id == user_id: 
          
-            db.session.delete(query_results)
+            db.session.delete(favorite_exists)
             db.session.commit()
             return ({"msg": "ok, its deleted"}), 200
 
@@ -700,6 +972,7 @@ def delete_favorite(favorite_id):
         
 # BORRAR PLANETAS EN BASE A SU NOMBRE        
 @app.route('/planet', methods=['DELETE'])
+@query_budget(4)
 def delete_planet():
     data = request.json
 
@@ -747,6 +1020,7 @@ jwt = JWTManager(app)
 # Create a route to authenticate your users and return JWTs. The
 # create_access_token() function is used to actually generate the JWT.
 @app.route("/login", methods=["POST"])
+@query_budget(1)
 def login():
     email = request.json.get("email", None)
     password = request.json.get("password", None)
@@ -760,12 +1034,13 @@ def login():
     if email != query_results.email or password != query_results.password:
          return jsonify({"msg": "Bad email or password"}), 401
     
-    access_token = create_access_token(identity=email)
+    access_token = create_user_token(query_results.id, email)
     return jsonify(access_token=access_token)
 
 
 #SIGN IN ############################################################################################
 @app.route("/signup", methods=["POST"])
+@query_budget(3)
 def signup():
     first_name = request.json.get("first_name", None)
     last_name = request.json.get("last_name", None)
@@ -783,8 +1058,10 @@ def signup():
                 password=password
                 )
             db.session.add(new_user)
+            db.session.flush()
+            user_id = new_user.id
             db.session.commit()
-            access_token = create_access_token(identity=email)
+            access_token = create_user_token(user_id, email)
             return jsonify(access_token=access_token), 200
             
     else:
@@ -797,24 +1074,23 @@ def signup():
 
 # PROTEGER UNA RUTA
 @app.route("/favorites", methods=["GET"])
+@query_budget(5)
+@read_only
+@compressed
 @jwt_required()
 def favorites_protected():
-    # Access the identity of the current user with get_jwt_identity
-    email = get_jwt_identity()
-    print(email)
-
-    user = User.query.filter_by(email=email).first()
-    print(user)
+    # Access the identity of the current user with get_current_user_id
+    user_id = get_current_user_id()
     
-    if user is None: 
+    if user_id is None: 
            return jsonify("wrong authorization/restricted area"), 401
 
     
-    user_favorites = Favorites.query.filter_by(user_id=user.id).all()
+    user_favorites, serialize = get_favorites_of_user(user_id)
 
     if user_favorites:
     
-        results = list(map(lambda item: item.serialize(), user_favorites))
+        results = list(map(serialize, user_favorites))
         return jsonify({"msg": "ok", "results": results}), 200
     
     else: 
@@ -824,11 +1100,12 @@ def favorites_protected():
 # CONDICIONAL RENDERING #############################################################################
 
 @app.route("/valid-token", methods=["GET"])
+@query_budget(1)
+@read_only
 @jwt_required()
 def valid_token():
-     current_user = get_jwt_identity()
-     querty_results = User.query.filter_by(email=current_user).first()
-     if querty_results is None:
+     current_user = get_current_user_id()
+     if current_user is None:
             return jsonify({"msg": "user does not exist",
                            "is_logged": False}), 404
      
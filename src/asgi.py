@@ -0,0 +1,363 @@
+"""
+ASGI entry point, the async counterpart of wsgi.py:
+
+    $ uvicorn asgi:application --app-dir src --workers 4
+
+The hot read routes (/all_*, /planets/<id>, /characters/<id>, /starships/<id>,
+/user/<id>) are served by coroutines over an AsyncEngine (asyncpg, aiosqlite
+or aiomysql, picked from DATABASE_URL), so a worker keeps answering while
+their queries wait on the database. They run inside a Flask request context
+and reuse the filters, pagination, serializers, entity cache, ETags,
+compression and after_request hooks of the WSGI routes, so the responses are
+the same byte for byte.
+
+Every other route (writes, auth, search, stats, ?stream) is handed to the
+Flask app on a thread pool of ASGI_THREADS threads, streaming its body back
+as the WSGI iterator produces it.
+"""
+import asyncio
+import io
+from contextvars import copy_context
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from flask import request, jsonify, make_response
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import NoSuchModuleError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from werkzeug.exceptions import HTTPException
+from app import app, entity_cache, cache_store
+from models import User, Planets, Characters, Starships, TableVersion
+from utils import paginate, wants_stream, get_fields, select_fields
+from filters import apply_filters, get_sort, is_filtered
+from serializers import serializer_for
+from versions import make_etag
+from compression import compress_response, etag_variants
+from budget import query_budget
+from pool import engine_options_from_env
+from replicas import sticky_to_primary
+
+ASYNC_DRIVERS = {"postgresql": "asyncpg", "sqlite": "aiosqlite", "mysql": "aiomysql"}
+
+def async_url(database_uri):
+    url = make_url(database_uri)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise NoSuchModuleError("no async driver known for %s" % backend)
+    return url.set(drivername="%s+%s" % (backend, ASYNC_DRIVERS[backend]))
+
+def async_engine_options(database_uri):
+    # the same pool sizes and timeouts as the sync engine; async engines
+    # need their own pool class, and asyncpg takes the statement timeout as
+    # a server setting instead of libpq options
+    options = engine_options_from_env(database_uri)
+    if options.pop("poolclass", None) is not None:
+        options["poolclass"] = AsyncAdaptedQueuePool
+    connect_args = options.get("connect_args", {})
+    if "options" in connect_args:
+        timeout = connect_args.pop("options").rpartition("=")[2]
+        connect_args["server_settings"] = {"statement_timeout": timeout}
+    return options
+
+class AsyncDatabase:
+    # the primary and the replicas of the app config, created on first use
+    # so importing this module doesn't need the async drivers
+
+    def __init__(self, config):
+        self.config = config
+        self.primary = None
+        self.replicas = []
+        self.sessions = async_sessionmaker(expire_on_commit=False)
+
+    def engines(self):
+        if self.primary is None:
+            uri = self.config['SQLALCHEMY_DATABASE_URI']
+            self.primary = create_async_engine(async_url(uri), **async_engine_options(uri))
+            binds = self.config.get('SQLALCHEMY_BINDS') or {}
+            self.replicas = [
+                create_async_engine(async_url(bind["url"]), **async_engine_options(bind["url"]))
+                for key, bind in sorted(binds.items()) if key.startswith("replica_")
+            ]
+        return self.primary, self.replicas
+
+    def session(self, primary=False):
+        # same rule as @read_only: a replica, unless the client just wrote
+        # (sticky_to_primary, checked by the caller) or what is read is going
+        # to be cached
+        engine, replicas = self.engines()
+        if replicas and not primary:
+            engine = random.choice(replicas)
+        return self.sessions(bind=engine)
+
+    async def dispose(self):
+        for engine in [self.primary] + self.replicas:
+            if engine is not None:
+                await engine.dispose()
+        self.primary, self.replicas = None, []
+
+database = AsyncDatabase(app.config)
+executor = ThreadPoolExecutor(app.config['ASGI_THREADS'], thread_name_prefix="wsgi")
+# its own pool, so cache lookups don't queue behind slow WSGI requests
+cache_executor = ThreadPoolExecutor(app.config['ASGI_THREADS'], thread_name_prefix="cache")
+
+async def cached(function, *args):
+    # a shared cache store may wait on Redis, which would stall every request
+    # on the event loop; the in-process cache only takes a lock and is called
+    # directly. The Flask context goes along to the pool thread
+    if cache_store is None:
+        return function(*args)
+    return await asyncio.get_running_loop().run_in_executor(cache_executor, copy_context().run, function, *args)
+
+############################################# NATIVE ROUTES
+
+# Flask endpoint name -> coroutine serving it
+NATIVE = {}
+# the ones Flask still serves when the client asks for ?stream / NDJSON
+STREAMABLE = set()
+
+def native(endpoint, streamable=False):
+    def decorator(view):
+        NATIVE[endpoint] = view
+        if streamable:
+            STREAMABLE.add(endpoint)
+        return view
+    return decorator
+
+async def table_version(session, model):
+    version = await session.scalar(select(TableVersion.version).filter_by(name=model.__tablename__))
+    return version or 0
+
+async def conditional(session, model, view):
+    # @compressed + @etag_by_version for a coroutine
+    etag = make_etag(model, await table_version(session, model))
+    for tag in etag_variants(etag):
+        if request.if_none_match.contains(tag):
+            response = make_response("", 304)
+            response.set_etag(tag)
+            return compress_response(response)
+
+    response = make_response(await view())
+    if response.status_code == 200:
+        response.set_etag(etag)
+    return compress_response(response)
+
+def catalog_page(model, label, filtered=True):
+    async def view(session):
+        with query_budget(2):
+            async def page():
+                sort = get_sort(model)
+                if filtered:
+                    query, serialize = select_fields(model, sort)
+                    query = apply_filters(query, model)
+                else:
+                    query, serialize = model.query, serializer_for(model)
+                # the sync Query runs on the async connection, same SQL and
+                # same rows (entities or tuples) as the WSGI route gets
+                items, next_cursor = await session.run_sync(
+                    lambda sync_session: paginate(query.with_session(sync_session), sort))
+                results = list(map(serialize, items))
+
+                if results == [] and request.args.get("after") is None and not (filtered and is_filtered()):
+                    return jsonify("no %s in the database" % label), 404
+                return jsonify({"msg": "ok", "results": results, "next_cursor": next_cursor}), 200
+            return await conditional(session, model, page)
+    return view
+
+native("get_all_users", streamable=True)(catalog_page(User, "users", filtered=False))
+native("get_all_planets", streamable=True)(catalog_page(Planets, "planets"))
+native("get_all_characters", streamable=True)(catalog_page(Characters, "characters"))
+native("get_all_starships", streamable=True)(catalog_page(Starships, "starships"))
+
+async def load_entity(session, model, entity_id, fields=None):
+    # EntityCache.get_or_load over the async session
+    payload = await cached(entity_cache.get, model, entity_id)
+    if payload is not None:
+        return payload if fields is None else {name: payload[name] for name in fields}
+
+    if fields is not None:
+        columns = [getattr(model, name) for name in fields]
+        row = (await session.execute(select(*columns).where(model.id == entity_id).limit(1))).first()
+        return None if row is None else serializer_for(model, fields, tuples=True)(row)
+
+    generation = await cached(entity_cache.generation, model)
+    statement = select(model).where(model.id == entity_id).limit(1)
+    if session.bind is database.primary:
+        item = (await session.execute(statement)).scalar()
+    else:
+        # what goes into the cache is read from the primary, see on_primary
+        async with database.session(primary=True) as primary:
+            item = (await primary.execute(statement)).scalar()
+    if item is None:
+        return None
+    return await cached(entity_cache.set, model, entity_id, serializer_for(model)(item), generation)
+
+def one_entity(model, missing, with_id=False, projected=True):
+    async def view(session, **view_args):
+        with query_budget(1):
+            entity_id, = view_args.values()
+            result = await load_entity(session, model, entity_id, get_fields(model) if projected else None)
+            if result is None:
+                return jsonify({"msg": missing}), 404
+            if with_id:
+                return jsonify({"msg": "ok", "id": result["id"], "results": result}), 200
+            return jsonify({"msg": "ok", "results": result}), 200
+    return view
+
+native("get_one_user")(one_entity(User, "there is no user matching the ID provided", projected=False))
+native("get_one_planet")(one_entity(Planets, "there is no planet matching the Name provided"))
+native("get_one_starship")(one_entity(Starships, "there is no starship matching the Name provided"))
+native("get_one_character")(one_entity(Characters, "there is no character matching the name provided", with_id=True))
+
+async def dispatch_native(view, environ):
+    # Flask.wsgi_app / full_dispatch_request with an awaited view; returns
+    # None when the request has to go through the WSGI app after all
+    ctx = app.request_context(environ)
+    error = None
+    ctx.push()
+    try:
+        if request.endpoint in STREAMABLE and wants_stream():
+            return None
+        try:
+            rv = app.preprocess_request()
+            if rv is None:
+                # a token pinned to the primary may have to be looked up in Redis
+                sticky = bool(database.engines()[1]) and await cached(sticky_to_primary)
+                async with database.session(primary=sticky) as session:
+                    rv = await view(session, **request.view_args)
+        except Exception as e:
+            rv = app.handle_user_exception(e)
+        return app.finalize_request(rv)
+    except Exception as e:
+        error = e
+        return app.handle_exception(e)
+    finally:
+        ctx.pop(error)
+
+def native_view(environ):
+    try:
+        endpoint, view_args = app.url_map.bind_to_environ(environ).match()
+    except HTTPException:
+        return None
+    return NATIVE.get(endpoint)
+
+############################################# ASGI <-> WSGI
+
+def wsgi_environ(scope, body):
+    script_name = scope.get("root_path", "")
+    path = scope["path"]
+    if script_name and path.startswith(script_name):
+        path = path[len(script_name):]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": script_name,
+        # WSGI strings are latin-1 decoded bytes
+        "PATH_INFO": path.encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope["http_version"],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = scope["client"][0], str(scope["client"][1])
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1")
+        if name == "content-type":
+            key = "CONTENT_TYPE"
+        elif name == "content-length":
+            key = "CONTENT_LENGTH"
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if key in environ:
+            value = environ[key] + "," + value
+        environ[key] = value
+    return environ
+
+def start_message(status, headers):
+    return {
+        "type": "http.response.start",
+        "status": int(status.split(" ", 1)[0]),
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+    }
+
+async def call_wsgi(environ, send):
+    # the Flask app runs on a pool thread; every chunk of its iterator is
+    # sent as soon as it is produced, so ?stream keeps its time to first byte
+    loop = asyncio.get_running_loop()
+
+    def send_from_thread(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    def run():
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [start_message(status, headers)]
+
+        iterable = app(environ, start_response)
+        try:
+            for chunk in iterable:
+                if not chunk:
+                    continue
+                if started:
+                    send_from_thread(started.pop())
+                send_from_thread({"type": "http.response.body", "body": chunk, "more_body": True})
+            if started:
+                send_from_thread(started.pop())
+            send_from_thread({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    await loop.run_in_executor(executor, run)
+
+async def send_response(response, send):
+    await send(start_message(response.status, response.headers.to_wsgi_list()))
+    await send({"type": "http.response.body", "body": response.get_data()})
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await database.dispose()
+            executor.shutdown(wait=False)
+            cache_executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        raise NotImplementedError("unsupported ASGI scope %s" % scope["type"])
+
+    environ = wsgi_environ(scope, await read_body(receive))
+    view = native_view(environ)
+    if view is not None:
+        response = await dispatch_native(view, environ)
+        if response is not None:
+            return await send_response(response, send)
+    await call_wsgi(environ, send)
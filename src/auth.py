@@ -0,0 +1,44 @@
+"""
+Resolves the identity of a JWT to a user id. The id travels in the token
+claims and the (user id -> email) pairs we have already verified are cached,
+so authenticated requests don't have to look the user up every time. With a
+shared CACHE_BACKEND the pairs live in the shared store, deleting or changing
+a user revokes them for every worker at once.
+"""
+from flask_jwt_extended import create_access_token, get_jwt, get_jwt_identity
+from cache import EntityCache
+from models import User
+from replicas import on_primary
+from shared_cache import make_entity_cache
+
+identity_cache = EntityCache()
+
+def setup_identity_cache(app, store=None):
+    global identity_cache
+    identity_cache = make_entity_cache(store, (User,), app.config['IDENTITY_CACHE_SIZE'],
+                                       app.config['IDENTITY_CACHE_TTL'], namespace="identity")
+    return identity_cache
+
+def create_user_token(user_id, email):
+    return create_access_token(identity=email, additional_claims={"user_id": user_id})
+
+def get_current_user_id():
+    email = get_jwt_identity()
+    user_id = get_jwt().get("user_id")
+
+    # tokens issued before the user id was part of the claims
+    if user_id is None:
+        user = User.query.filter_by(email=email).first()
+        return None if user is None else user.id
+
+    if identity_cache.get(User, user_id) == email:
+        return user_id
+
+    generation = identity_cache.generation(User)
+    with on_primary():
+        user = User.query.filter_by(id=user_id).first()
+    # a deleted user, or one whose email changed, no longer owns this token
+    if user is None or user.email != email:
+        return None
+    identity_cache.set(User, user_id, email, generation)
+    return user_id
@@ -0,0 +1,48 @@
+"""
+Multi-get by id: GET /planets?ids=3,1,2 or POST /planets {"ids": [3, 1, 2]}
+(same for characters, starships and, for admins, users). Cached entities come
+from the entity cache, the rest is loaded with one IN query per chunk; results
+keep the requested order and the ids that don't exist are listed in "missing".
+"""
+from flask import g, request, current_app
+from utils import APIException, integer_in_range
+
+def read_ids(model):
+    if request.method == "POST":
+        body = request.get_json(silent=True)
+        ids = body.get("ids") if isinstance(body, dict) else None
+        # bools are ints for Python, not for the client
+        if isinstance(ids, list) and not all(isinstance(value, int) and not isinstance(value, bool) for value in ids):
+            raise APIException("ids must be integers", status_code=400)
+    else:
+        ids = request.args.get("ids")
+        if ids is not None:
+            try:
+                ids = [int(value) for value in ids.split(",") if value.strip()]
+            except ValueError:
+                raise APIException("ids must be integers", status_code=400)
+
+    if not isinstance(ids, list) or not ids:
+        raise APIException('expected a list of ids, ?ids=1,2,3 or {"ids": [1, 2, 3]}', status_code=400)
+    # an id the column can't hold doesn't exist, but the driver fails on it
+    if not all(integer_in_range(model.id, value) for value in ids):
+        raise APIException("ids must be integers", status_code=400)
+    if len(ids) > current_app.config["BATCH_MAX_IDS"]:
+        raise APIException("too many ids, the limit is %s" % current_app.config["BATCH_MAX_IDS"], status_code=413)
+    # repeated ids come back once, where they first appeared
+    return list(dict.fromkeys(ids))
+
+def batch_query_budget():
+    # at most one IN query per chunk, less when the cache has some of them
+    return g.get("batch_chunks", 0)
+
+def batch_get(cache, model, fields=None):
+    ids = read_ids(model)
+    chunk_size = current_app.config["BATCH_CHUNK_SIZE"]
+    g.batch_chunks = -(-len(ids) // chunk_size)
+    found = cache.get_many_or_load(model, ids, fields, chunk_size)
+    return {
+        "msg": "ok",
+        "results": [found[entity_id] for entity_id in ids if entity_id in found],
+        "missing": [entity_id for entity_id in ids if entity_id not in found],
+    }
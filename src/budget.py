@@ -0,0 +1,68 @@
+"""
+Query budgets: @query_budget(n) on a route (or `with query_budget(n):` around
+any block) counts the SQL statements executed inside it and complains when
+there are more than n or when the very same statement runs twice. n can be a
+callable for routes whose queries grow with the input (bulk creation).
+
+In debug/testing (or with QUERY_BUDGET_ENFORCE=1) going over budget raises
+QueryBudgetExceeded, so a query regression fails the request that caused it;
+in production it is only logged.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import current_app, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# statement lists of the budgets open in this context, innermost last
+_recorders = ContextVar("query_budget_recorders", default=())
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+@event.listens_for(Engine, "before_cursor_execute")
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    for statements in _recorders.get():
+        statements.append((statement, parameters, executemany))
+
+def statement_key(statement, parameters, executemany):
+    # an executemany is split in several batches of the same INSERT, those
+    # are not repeats
+    if executemany:
+        return None
+    return "%s %r" % (statement, parameters)
+
+def check_budget(name, limit, statements):
+    if callable(limit):
+        limit = limit()
+    problems = []
+    if len(statements) > limit:
+        problems.append("%d queries, budget is %d" % (len(statements), limit))
+    repeated = [key for key, count in Counter(statement_key(*item) for item in statements).items()
+                if key is not None and count > 1]
+    if repeated:
+        problems.append("repeated statements: %s" % "; ".join(key[:300] for key in repeated))
+    if not problems:
+        return
+
+    message = "%s: %s" % (name, ", ".join(problems))
+    if not has_app_context():
+        # used directly in a test, outside any app
+        raise QueryBudgetExceeded(message)
+    config = current_app.config
+    if current_app.debug or current_app.testing or config.get('QUERY_BUDGET_ENFORCE'):
+        raise QueryBudgetExceeded(message)
+    current_app.logger.warning("query budget exceeded in %s", message)
+
+@contextmanager
+def query_budget(limit, name=None):
+    statements = []
+    token = _recorders.set(_recorders.get() + (statements,))
+    try:
+        yield statements
+    finally:
+        _recorders.reset(token)
+    if name is None:
+        name = request.endpoint if has_request_context() else "query_budget"
+    check_budget(name, limit, statements)
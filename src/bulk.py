@@ -0,0 +1,133 @@
+"""
+Bulk creation of catalog entities (planets, characters, starships) from a JSON
+array or an NDJSON body, validated against the column types, deduplicated by
+name and inserted in one transaction
+"""
+import json
+from flask import g, request, current_app
+from sqlalchemy import insert, select, Integer, String
+from utils import APIException, integer_in_range
+from models import db
+
+def read_bulk_body():
+    if request.mimetype == "application/x-ndjson":
+        try:
+            items = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        except ValueError:
+            raise APIException("invalid NDJSON body", status_code=400)
+    else:
+        items = request.get_json(silent=True)
+
+    if not isinstance(items, list):
+        raise APIException("expected a JSON array or an NDJSON body", status_code=400)
+    if len(items) > current_app.config["BULK_MAX_ITEMS"]:
+        raise APIException("too many items, the limit is %s" % current_app.config["BULK_MAX_ITEMS"], status_code=413)
+    return items
+
+def chunked(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def bulk_query_budget():
+    # an IN lookup and an INSERT per chunk, plus the table version bump
+    return 2 * g.get("bulk_chunks", 0) + 1
+
+def coerce_field(column, value):
+    # the value to insert for column, or ValueError with what is wrong: a bad
+    # value must be reported on its item, not fail the INSERT for the whole body
+    if value is None:
+        if column.nullable:
+            return None
+        raise ValueError("can't be null")
+    if isinstance(column.type, Integer):
+        if isinstance(value, str):
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if not isinstance(value, int) or isinstance(value, bool):
+            raise ValueError("must be an integer")
+        if not integer_in_range(column, value):
+            raise ValueError("out of range")
+        return value
+    if isinstance(column.type, String):
+        if not isinstance(value, str):
+            raise ValueError("must be a string")
+        if column.type.length is not None and len(value) > column.type.length:
+            raise ValueError("longer than %s characters" % column.type.length)
+        return value
+    return value
+
+def validate_item(columns, item):
+    # (row, None) for a valid item, (None, errors by field) otherwise
+    if not isinstance(item, dict):
+        return None, {"item": "must be an object"}
+    row, errors = {}, {}
+    for name in item:
+        if name not in columns:
+            errors[name] = "unknown field"
+    for name, column in columns.items():
+        if name not in item:
+            errors[name] = "missing"
+            continue
+        try:
+            row[name] = coerce_field(column, item[name])
+        except ValueError as error:
+            errors[name] = str(error)
+    return (None, errors) if errors else (row, None)
+
+def bulk_create(model):
+    items = read_bulk_body()
+    chunk_size = current_app.config["BULK_CHUNK_SIZE"]
+    g.bulk_chunks = -(-len(items) // chunk_size)
+    columns = {column.name: column for column in model.__table__.columns if column.name != "id"}
+
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        row, errors = validate_item(columns, item)
+        if errors:
+            results[index] = {"index": index, "status": "invalid", "msg": "invalid fields, expected %s" % ", ".join(columns), "errors": errors}
+        else:
+            valid.append((index, row))
+
+    # one IN query per chunk of names instead of one SELECT per item
+    names = list({item["name"] for index, item in valid})
+    existing = set()
+    for chunk in chunked(names, chunk_size):
+        existing.update(db.session.scalars(select(model.name).where(model.name.in_(chunk))))
+
+    pending = []
+    for index, item in valid:
+        if item["name"] in existing:
+            results[index] = {"index": index, "name": item["name"], "status": "skipped", "msg": "already included in the database"}
+            continue
+        existing.add(item["name"])
+        pending.append((index, item))
+
+    # names are unique among the pending rows, so RETURNING (id, name) can be
+    # matched back without asking for ordered results, which would make some
+    # dialects fall back to one INSERT per row
+    returns_ids = db.session.get_bind().dialect.insert_executemany_returning
+    for chunk in chunked(pending, chunk_size):
+        rows = [row for index, row in chunk]
+        ids = {}
+        if returns_ids:
+            ids = dict(db.session.execute(insert(model).returning(model.name, model.id), rows).all())
+        else:
+            db.session.execute(insert(model), rows)
+        for index, row in chunk:
+            results[index] = {"index": index, "name": row["name"], "status": "created", "id": ids.get(row["name"])}
+    db.session.commit()
+
+    created = sum(1 for result in results if result["status"] == "created")
+    invalid = sum(1 for result in results if result["status"] == "invalid")
+    return {
+        "msg": "ok",
+        "created": created,
+        "skipped": len(results) - created - invalid,
+        "invalid": invalid,
+        "results": results,
+    }
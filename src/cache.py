@@ -0,0 +1,146 @@
+"""
+In-process LRU + TTL cache for the serialized payload of single entities
+"""
+import threading
+import time
+from collections import OrderedDict
+from serializers import serializer_for
+from replicas import on_primary
+
+class EntityCache:
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, model, entity_id):
+        key = (model, entity_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, model, entity_id, payload, generation=None):
+        with self._lock:
+            # a write committed while the payload was being loaded, don't cache stale data
+            if generation is not None and generation != self._generations.get(model, 0):
+                return payload
+            self._entries[(model, entity_id)] = (time.monotonic() + self.ttl, payload)
+            self._entries.move_to_end((model, entity_id))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return payload
+
+    def generation(self, model):
+        return self._generations.get(model, 0)
+
+    def get_or_load(self, model, entity_id, fields=None):
+        payload = self.get(model, entity_id)
+        if payload is not None:
+            return payload if fields is None else {name: payload[name] for name in fields}
+
+        if fields is not None:
+            # partial rows are not cached, only the columns asked for are loaded
+            columns = [getattr(model, name) for name in fields]
+            row = model.query.with_entities(*columns).filter_by(id=entity_id).first()
+            return None if row is None else serializer_for(model, fields, tuples=True)(row)
+
+        generation = self.generation(model)
+        with on_primary():
+            item = model.query.filter_by(id=entity_id).first()
+        if item is None:
+            return None
+        return self.set(model, entity_id, serializer_for(model)(item), generation)
+
+    def get_many(self, model, ids):
+        # {id: payload} of the ids that are cached
+        found = {}
+        for entity_id in ids:
+            payload = self.get(model, entity_id)
+            if payload is not None:
+                found[entity_id] = payload
+        return found
+
+    def set_many(self, model, payloads, generation=None):
+        for entity_id, payload in payloads.items():
+            self.set(model, entity_id, payload, generation)
+
+    def get_many_or_load(self, model, ids, fields=None, chunk_size=500):
+        # get_or_load for a list of ids: the misses are loaded with one
+        # `id IN (...)` query per chunk; ids that don't exist are left out
+        found = self.get_many(model, ids)
+        if fields is not None:
+            found = {entity_id: {name: payload[name] for name in fields} for entity_id, payload in found.items()}
+        missing = [entity_id for entity_id in ids if entity_id not in found]
+        if not missing:
+            return found
+
+        if fields is not None:
+            columns = [getattr(model, name) for name in fields]
+            serialize = serializer_for(model, fields, tuples=True)
+            for start in range(0, len(missing), chunk_size):
+                query = model.query.with_entities(*columns).filter(model.id.in_(missing[start:start + chunk_size]))
+                # fields always starts with the id
+                found.update((row[0], serialize(row)) for row in query)
+            return found
+
+        generation = self.generation(model)
+        serialize = serializer_for(model)
+        loaded = {}
+        with on_primary():
+            for start in range(0, len(missing), chunk_size):
+                for item in model.query.filter(model.id.in_(missing[start:start + chunk_size])):
+                    loaded[item.id] = serialize(item)
+        self.set_many(model, loaded, generation)
+        found.update(loaded)
+        return found
+
+    def invalidate(self, model, entity_id=None):
+        with self._lock:
+            self._generations[model] = self._generations.get(model, 0) + 1
+            if entity_id is not None:
+                self._entries.pop((model, entity_id), None)
+                return
+            for key in [key for key in self._entries if key[0] is model]:
+                del self._entries[key]
+
+    def invalidate_touched(self, touched):
+        for model, ids in touched.items():
+            if ids is None:
+                self.invalidate(model)
+            else:
+                for entity_id in ids:
+                    self.invalidate(model, entity_id)
+
+    def invalidate_models(self, touched):
+        for model in touched:
+            self.invalidate(model)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
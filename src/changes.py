@@ -0,0 +1,56 @@
+"""
+Keeps track of the rows every commit touched, so the caches built on top of the
+database are invalidated from a single place whatever the write path was
+(our endpoints, bulk statements or the admin).
+"""
+from itertools import chain
+from sqlalchemy import event
+
+_subscribers = []
+
+def on_commit(callback):
+    # callback(touched) receives {Model: set of ids} after every commit that
+    # wrote something; the set is None when a bulk statement hit the whole table
+    _subscribers.append(callback)
+    return callback
+
+def mark_touched(session, model, entity_id=None):
+    touched = session.info.setdefault("touched", {})
+    if entity_id is None:
+        touched[model] = None
+    elif touched.get(model, set()) is not None:
+        touched.setdefault(model, set()).add(entity_id)
+
+def setup_change_tracking(db):
+
+    @event.listens_for(db.session, "after_flush")
+    def after_flush(session, flush_context):
+        for item in chain(session.new, session.dirty, session.deleted):
+            mark_touched(session, type(item), item.id)
+
+    @event.listens_for(db.session, "do_orm_execute")
+    def after_bulk_statement(orm_execute_state):
+        if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+            mapper = orm_execute_state.bind_mapper
+            if mapper is None:
+                return
+            returning = [column["name"] for column in orm_execute_state.statement.returning_column_descriptions]
+            if orm_execute_state.is_insert and "id" in returning:
+                # an INSERT only adds rows: with the ids in its RETURNING rows
+                # there is no need to throw away everything cached for the table
+                frozen = orm_execute_state.invoke_statement().freeze()
+                for row in frozen().mappings():
+                    mark_touched(orm_execute_state.session, mapper.class_, row["id"])
+                return frozen()
+            mark_touched(orm_execute_state.session, mapper.class_)
+
+    @event.listens_for(db.session, "after_commit")
+    def after_commit(session):
+        touched = session.info.pop("touched", None)
+        if touched:
+            for callback in _subscribers:
+                callback(touched)
+
+    @event.listens_for(db.session, "after_rollback")
+    def after_rollback(session):
+        session.info.pop("touched", None)
@@ -0,0 +1,80 @@
+"""
+Response compression negotiated with Accept-Encoding, switched on per route
+with the @compressed decorator. gzip is always available, brotli and zstd
+are used when their packages are installed.
+"""
+import zlib
+from functools import wraps
+from importlib.util import find_spec
+from flask import request, current_app, make_response
+
+# server preference when the client accepts several with the same quality;
+# brotli and zstandard are only imported the first time they are used
+ENCODINGS = [name for name, module in (("zstd", "zstandard"), ("br", "brotli"), ("gzip", "zlib")) if find_spec(module)]
+
+def etag_variants(etag):
+    # a compressed body gets its own strong ETag (tag-gzip, tag-br...), a
+    # client revalidating any of them is asking about the same representation
+    return [etag] + ["%s-%s" % (etag, encoding) for encoding in ENCODINGS]
+
+def make_compressor(encoding):
+    config = current_app.config
+    if encoding == "zstd":
+        import zstandard
+        compressor = zstandard.ZstdCompressor(level=config['COMPRESS_ZSTD_LEVEL']).compressobj()
+        return (lambda data: compressor.compress(data) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+                compressor.flush)
+    if encoding == "br":
+        import brotli
+        compressor = brotli.Compressor(quality=config['COMPRESS_BROTLI_LEVEL'])
+        return (lambda data: compressor.process(data) + compressor.flush(),
+                compressor.finish)
+    compressor = zlib.compressobj(config['COMPRESS_LEVEL'], zlib.DEFLATED, 31)
+    return (lambda data: compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH),
+            compressor.flush)
+
+def compress_stream(chunks, encoding):
+    # every chunk is flushed as soon as it is compressed so streaming keeps
+    # its time to first byte, nothing is buffered beyond the current chunk
+    compress, finish = make_compressor(encoding)
+    for chunk in chunks:
+        if chunk:
+            yield compress(chunk)
+    yield finish()
+
+def compress_response(response):
+    config = current_app.config
+    if not config['COMPRESS_ENABLED'] or response.status_code not in (200, 304) or "Content-Encoding" in response.headers:
+        return response
+    # a 304 carries the Vary of the 200 it stands for, or a shared cache could
+    # revalidate one encoding's entry with the 304 and serve it to any client
+    response.vary.add("Accept-Encoding")
+    if response.status_code == 304:
+        return response
+
+    allowed = [encoding for encoding in ENCODINGS if encoding in config['COMPRESS_ALGORITHMS']]
+    encoding = request.accept_encodings.best_match(allowed)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.iter_encoded(), encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < config['COMPRESS_MIN_SIZE']:
+            return response
+        compress, finish = make_compressor(encoding)
+        response.set_data(compress(data) + finish())
+
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag("%s-%s" % (etag, encoding), weak)
+    return response
+
+def compressed(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        return compress_response(make_response(view(*args, **kwargs)))
+    return wrapper
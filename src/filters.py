@@ -0,0 +1,83 @@
+"""
+Query string filters and sorting for the catalog collections, e.g.
+
+    /all_planets?climate=arid&population__gt=1000000&sort=-diameter
+
+Only the columns a model lists in filterable_columns / sortable_columns can
+be used, everything is compiled to a SQL WHERE / ORDER BY.
+"""
+from flask import request
+from sqlalchemy import Integer
+from utils import APIException, integer_in_range
+
+OPERATORS = {
+    "eq": lambda column, value: column == value,
+    "ne": lambda column, value: column != value,
+    "gt": lambda column, value: column > value,
+    "gte": lambda column, value: column >= value,
+    "lt": lambda column, value: column < value,
+    "lte": lambda column, value: column <= value,
+    "in": lambda column, values: column.in_(values),
+}
+
+# query string arguments that are not filters
+RESERVED_ARGS = {"limit", "after", "fields", "stream", "sort", "expand"}
+
+def coerce(model, name, value):
+    column = getattr(model, name)
+    try:
+        value = column.type.python_type(value)
+    except ValueError:
+        raise APIException("invalid value for %s: %s" % (name, value), status_code=400)
+    if isinstance(column.type, Integer) and not integer_in_range(column, value):
+        raise APIException("value out of range for %s: %s" % (name, value), status_code=400)
+    return value
+
+def is_filtered():
+    # an empty page of a filtered collection is a valid answer, not a 404
+    return any(arg not in RESERVED_ARGS for arg in request.args)
+
+def get_filters(model):
+    filterable = getattr(model, "filterable_columns", ())
+    conditions = []
+    for arg, value in request.args.items(multi=True):
+        if arg in RESERVED_ARGS:
+            continue
+        name, _, op = arg.partition("__")
+        op = op or "eq"
+        if name not in filterable:
+            raise APIException("can't filter by %s" % name, status_code=400)
+        if op not in OPERATORS:
+            raise APIException("unknown operator %s, use one of %s" % (op, ", ".join(OPERATORS)), status_code=400)
+        if op == "in":
+            value = [coerce(model, name, item) for item in value.split(",")]
+        else:
+            value = coerce(model, name, value)
+        conditions.append(OPERATORS[op](getattr(model, name), value))
+    return conditions
+
+def apply_filters(query, model):
+    conditions = get_filters(model)
+    return query.filter(*conditions) if conditions else query
+
+def get_sort(model):
+    # list of (column, descending), always ending with the primary key so the
+    # order is total and can be used as a keyset for pagination
+    sortable = getattr(model, "sortable_columns", ())
+    keys = []
+    id_descending = False
+    for name in request.args.get("sort", "").split(","):
+        name = name.strip()
+        if not name:
+            continue
+        descending = name.startswith("-")
+        name = name.lstrip("-")
+        if name not in sortable:
+            raise APIException("can't sort by %s" % name, status_code=400)
+        if name == "id":
+            # unique, anything sorted after it would never be compared
+            id_descending = descending
+            break
+        keys.append((getattr(model, name), descending))
+    keys.append((model.id, id_descending))
+    return keys
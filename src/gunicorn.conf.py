@@ -0,0 +1,137 @@
+"""
+Production gunicorn settings, used by the Procfile and render.yaml:
+
+    $ gunicorn wsgi --chdir ./src/ --config ./src/gunicorn.conf.py
+
+Everything can be overridden with the usual GUNICORN_CMD_ARGS / command line
+flags or the environment variables below. Each worker opens up to
+DB_POOL_SIZE + DB_MAX_OVERFLOW connections, keep workers * that under the
+connection limit of the database.
+"""
+import gc
+import glob
+import os
+import shutil
+import tempfile
+
+def cpu_count():
+    # the CPUs this container may run on, not the ones of the host
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# WEB_CONCURRENCY is the variable Render and Heroku size for the instance
+workers = int(os.getenv("WEB_CONCURRENCY", cpu_count() * 2 + 1))
+threads = int(os.getenv("WEB_THREADS", 4))
+worker_class = "gthread" if threads > 1 else "sync"
+timeout = int(os.getenv("WEB_TIMEOUT", 30))
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.getenv("WEB_KEEPALIVE", 5))
+# the heartbeat file on tmpfs, a disk-backed /tmp can stall it under load
+if os.path.isdir("/dev/shm"):
+    worker_tmp_dir = "/dev/shm"
+
+# the app is imported once in the master: workers start fast and share the
+# imported modules copy-on-write instead of each importing its own
+preload_app = True
+
+# no recycling by default: a gthread worker that restarts closes the
+# keep-alive connections it holds, and requests sent on them are lost.
+# WEB_MAX_WORKER_RSS_MB restarts only a worker whose memory actually grew past
+# it; WEB_MAX_REQUESTS is still there for a leak that needs it
+max_requests = int(os.getenv("WEB_MAX_REQUESTS", 0))
+max_requests_jitter = int(os.getenv("WEB_MAX_REQUESTS_JITTER", 0))
+max_worker_rss = int(os.getenv("WEB_MAX_WORKER_RSS_MB", 0)) * 1024 * 1024
+
+# /metrics adds up the samples of every worker through this directory; it has
+# to be set before the app is imported, which preload_app does right after.
+# One we create is removed again when the server exits (kept in the
+# environment, a reload on SIGHUP reads this file again)
+if workers > 1 and not os.getenv("METRICS_DIR"):
+    os.environ["METRICS_DIR"] = os.environ["CREATED_METRICS_DIR"] = tempfile.mkdtemp(prefix="metrics-")
+
+# with one in-process cache per worker a write only invalidates the worker that
+# committed it: the others would keep serving the old row (and accepting the
+# token of a deleted user) until the TTL. Shared by default, like the metrics
+if workers > 1 and not os.getenv("CACHE_BACKEND"):
+    os.environ["CACHE_BACKEND"] = "shm"
+
+def worker_rss():
+    # resident memory of this process in bytes, 0 where /proc isn't available
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+def on_starting(server):
+    # the files of a previous run would be counted as workers that exited
+    directory = os.getenv("METRICS_DIR")
+    if directory:
+        for path in glob.glob(os.path.join(directory, "metrics-*.json*")):
+            os.remove(path)
+    if server.cfg.workers > 1 and os.getenv("CACHE_BACKEND") == "memory":
+        server.log.warning("CACHE_BACKEND=memory with %s workers: a write only invalidates the cache "
+                           "of the worker that made it", server.cfg.workers)
+    # a shared cache outlives the server, and misses the writes made while it
+    # was down (migrations, `flask seed`): new epochs for this deployment's
+    # tables, what the other hosts and deployments cached is left alone
+    from app import entity_cache, identity_cache
+    from shared_cache import SharedEntityCache
+    for cache in (entity_cache, identity_cache):
+        if isinstance(cache, SharedEntityCache):
+            cache.invalidate_models(cache.models)
+
+def when_ready(server):
+    # the /search index is built once here and shared by every worker,
+    # instead of each (recycled) worker building its own on a live request
+    from app import app, name_index
+    from models import db
+    with app.app_context():
+        try:
+            name_index.warm()
+        except Exception:
+            server.log.exception("search index not built, workers will build it on the first search")
+        # the master doesn't serve requests, nothing for it to keep open
+        for engine in db.engines.values():
+            engine.dispose()
+    # everything the import created is moved out of the collector's reach, so
+    # a collection in a worker doesn't write to (and copy) the shared pages
+    gc.freeze()
+
+def post_fork(server, worker):
+    # the engines were created in the master: drop the pooled connections the
+    # worker inherited without closing them, they belong to the parent
+    from app import app
+    from models import db
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+def post_request(worker, req, environ, resp):
+    # stops taking new requests and exits once the ones in flight are answered,
+    # the master forks a fresh worker in its place
+    if max_worker_rss and worker.alive and worker_rss() > max_worker_rss:
+        worker.log.info("worker using more than %s MB, restarting it", max_worker_rss // (1024 * 1024))
+        worker.alive = False
+
+def worker_exit(server, worker):
+    # the last requests of a recycled worker still count in /metrics
+    from metrics import metrics
+    metrics.flush(force=True)
+
+def child_exit(server, worker):
+    # runs in the master after worker_exit flushed the worker's last samples
+    directory = os.getenv("METRICS_DIR")
+    if directory:
+        from metrics import fold_exited
+        try:
+            fold_exited(directory, worker.pid)
+        except Exception:
+            server.log.exception("metrics of worker %s not folded", worker.pid)
+
+def on_exit(server):
+    directory = os.getenv("CREATED_METRICS_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
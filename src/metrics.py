@@ -0,0 +1,316 @@
+"""
+Request and database instrumentation exposed at /metrics in the Prometheus
+text format.
+
+Every request records its latency, status and the number and duration of the
+SQL statements it ran, under a single lock acquisition at the end of the
+request. With METRICS_DIR set (gunicorn with several workers) each worker
+periodically writes its samples to METRICS_DIR/metrics-<pid>-<start>.json and
+/metrics adds up the files of every worker; the directory has to be emptied
+before the workers start. When a worker exits the master folds its counters
+and histograms into METRICS_DIR/metrics-exited.json (fold_exited) and removes
+its file, so the directory holds one file per live worker plus that one.
+"""
+import atexit
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from contextvars import ContextVar
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+HISTOGRAMS = {
+    "http_request_duration_seconds": ("Request latency until the response is returned by the view.", LATENCY_BUCKETS),
+    "db_queries_per_request": ("SQL statements executed by a request.", QUERY_COUNT_BUCKETS),
+}
+COUNTERS = {
+    "http_requests_total": "Requests handled, by endpoint, method and status.",
+    "db_queries_total": "SQL statements executed, by endpoint.",
+    "db_query_seconds_total": "Time spent executing SQL statements, by endpoint.",
+}
+GAUGES = {
+    "http_requests_in_progress": "Requests currently being handled.",
+}
+
+# [statements, seconds] of the request running in this context
+_request_queries = ContextVar("request_queries", default=None)
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.in_progress = 0
+        self.collectors = []
+        self.directory = None
+        self.flush_seconds = 5
+        self.started = int(time.time())
+        self._flushed_at = 0.0
+
+    def register_collector(self, collector):
+        # collector() returns (name, type, help, labels, value) tuples read at
+        # flush/scrape time, for stats other modules already keep (caches, pools)
+        self.collectors.append(collector)
+        return collector
+
+    def _observe(self, name, labels, value):
+        buckets = HISTOGRAMS[name][1]
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = [0] * (len(buckets) + 1) + [0.0]
+        histogram[bisect.bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+
+    def _inc(self, name, labels, value=1):
+        self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def request_started(self):
+        with self._lock:
+            self.in_progress += 1
+
+    def request_finished(self, endpoint, method, status, seconds, queries, query_seconds):
+        with self._lock:
+            self.in_progress -= 1
+            self._inc("http_requests_total", (("endpoint", endpoint), ("method", method), ("status", str(status))))
+            self._observe("http_request_duration_seconds", (("endpoint", endpoint), ("method", method)), seconds)
+            self._observe("db_queries_per_request", (("endpoint", endpoint),), queries)
+            self._inc("db_queries_total", (("endpoint", endpoint),), queries)
+            self._inc("db_query_seconds_total", (("endpoint", endpoint),), query_seconds)
+
+    def snapshot(self):
+        with self._lock:
+            counters = [[name, list(labels), value] for (name, labels), value in self.counters.items()]
+            histograms = [[name, list(labels), list(values)] for (name, labels), values in self.histograms.items()]
+            in_progress = self.in_progress
+        gauges = [["http_requests_in_progress", [], in_progress]]
+        collected = [list(sample) for collector in self.collectors for sample in collector()]
+        return {"pid": os.getpid(), "counters": counters, "histograms": histograms,
+                "gauges": gauges, "collected": collected}
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        if self.directory is None or (not force and now - self._flushed_at < self.flush_seconds):
+            return
+        self._flushed_at = now
+        path = os.path.join(self.directory, "metrics-%d-%d.json" % (os.getpid(), self.started))
+        try:
+            with open(path + ".tmp", "w") as snapshot_file:
+                json.dump(self.snapshot(), snapshot_file)
+            os.replace(path + ".tmp", path)
+        except FileNotFoundError:
+            # the server has stopped and removed the directory (on_exit)
+            pass
+
+    def snapshots(self):
+        if self.directory is None:
+            return [self.snapshot()]
+        self.flush(force=True)
+        snapshots = {}
+        for path in glob.glob(os.path.join(self.directory, "metrics-*.json")):
+            snapshot = read_snapshot(path)
+            if snapshot is not None:
+                snapshots[os.path.basename(path)] = snapshot
+        # a file listed as folded may still be read just before fold_exited
+        # removes it, its samples are in the aggregate already
+        folded = set(snapshots.get(EXITED, {}).get("folded", ()))
+        return [snapshot for name, snapshot in snapshots.items() if name not in folded]
+
+metrics = Metrics()
+
+EXITED = "metrics-exited.json"
+# names of the last files folded, enough to cover the scrapes running meanwhile
+FOLDED_NAMES = 100
+
+def read_snapshot(path):
+    try:
+        with open(path) as snapshot_file:
+            return json.load(snapshot_file)
+    except (OSError, ValueError):
+        return None
+
+def fold_exited(directory, pid):
+    # run by the gunicorn master (child_exit) once worker pid is gone: its
+    # counters and histograms keep counting from the aggregate file, its gauges
+    # and collected stats are dropped, and a new worker reusing the pid starts
+    # from a file of its own instead of being mixed with the old one
+    paths = glob.glob(os.path.join(directory, "metrics-%d-*.json" % pid))
+    aggregate_path = os.path.join(directory, EXITED)
+    aggregate = read_snapshot(aggregate_path) or {
+        "pid": None, "counters": [], "histograms": [], "gauges": [], "collected": [], "folded": []}
+    counters = {(name, json.dumps(labels)): value for name, labels, value in aggregate["counters"]}
+    histograms = {(name, json.dumps(labels)): values for name, labels, values in aggregate["histograms"]}
+
+    for path in paths:
+        snapshot = read_snapshot(path)
+        if snapshot is None:
+            continue
+        for name, labels, value in snapshot["counters"]:
+            key = (name, json.dumps(labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snapshot["histograms"]:
+            key = (name, json.dumps(labels))
+            if key in histograms:
+                values = [total + value for total, value in zip(histograms[key], values)]
+            histograms[key] = values
+
+    aggregate["counters"] = [[name, json.loads(labels), value] for (name, labels), value in counters.items()]
+    aggregate["histograms"] = [[name, json.loads(labels), values] for (name, labels), values in histograms.items()]
+    aggregate["folded"] = (aggregate["folded"] + [os.path.basename(path) for path in paths])[-FOLDED_NAMES:]
+    with open(aggregate_path + ".tmp", "w") as aggregate_file:
+        json.dump(aggregate, aggregate_file)
+    os.replace(aggregate_path + ".tmp", aggregate_path)
+    for path in paths + glob.glob(os.path.join(directory, "metrics-%d-*.json.tmp" % pid)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def merge(snapshots):
+    # counters and histograms of workers that exited still count (totals must
+    # not go backwards when gunicorn recycles a worker), gauges and collected
+    # stats only come from the workers that are alive; the aggregate of the
+    # exited ones has no pid
+    samples, types, helps = {}, {}, {}
+
+    def add(name, labels, value):
+        key = (name, tuple(tuple(label) for label in labels))
+        samples[key] = samples.get(key, 0) + value
+
+    for snapshot in snapshots:
+        pid = snapshot["pid"]
+        alive = pid is not None and (pid == os.getpid() or pid_alive(pid))
+        for name, labels, value in snapshot["counters"]:
+            add(name, labels, value)
+        for name, labels, values in snapshot["histograms"]:
+            buckets = HISTOGRAMS[name][1]
+            cumulative = 0
+            for bound, count in zip(buckets + ("+Inf",), values):
+                cumulative += count
+                add(name + "_bucket", labels + [["le", str(bound)]], cumulative)
+            add(name + "_count", labels, cumulative)
+            add(name + "_sum", labels, values[-1])
+        if alive:
+            for name, labels, value in snapshot["gauges"]:
+                add(name, labels, value)
+            for name, kind, help_text, labels, value in snapshot["collected"]:
+                types[name], helps[name] = kind, help_text
+                add(name, sorted(labels.items()), value)
+    return samples, types, helps
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_sample(name, labels, value):
+    if labels:
+        name += "{%s}" % ",".join('%s="%s"' % (key, escape(label)) for key, label in labels)
+    return "%s %s" % (name, repr(float(value)) if isinstance(value, float) else value)
+
+def render_metrics():
+    samples, types, helps = merge(metrics.snapshots())
+    families = {name: ("histogram", help_text) for name, (help_text, _) in HISTOGRAMS.items()}
+    families.update((name, ("counter", help_text)) for name, help_text in COUNTERS.items())
+    families.update((name, ("gauge", help_text)) for name, help_text in GAUGES.items())
+    families.update((name, (types[name], helps[name])) for name in types)
+
+    by_family = {}
+    # samples keep the order merge() added them in, so every histogram lists
+    # its buckets from the smallest bound up to +Inf
+    for (name, labels), value in samples.items():
+        family = name
+        for suffix in ("_bucket", "_count", "_sum"):
+            if name.endswith(suffix) and name[:-len(suffix)] in HISTOGRAMS:
+                family = name[:-len(suffix)]
+        by_family.setdefault(family, []).append(format_sample(name, labels, value))
+
+    lines = []
+    for family, family_lines in by_family.items():
+        kind, help_text = families.get(family, ("untyped", ""))
+        lines += ["# HELP %s %s" % (family, help_text), "# TYPE %s %s" % (family, kind)]
+        lines += family_lines
+    return "\n".join(lines) + "\n"
+
+def cache_samples(cache_name, stats):
+    labels = {"cache": cache_name}
+    yield ("cache_hits_total", "counter", "Cache lookups that found a live entry.", labels, stats["hits"])
+    yield ("cache_misses_total", "counter", "Cache lookups that had to load the value.", labels, stats["misses"])
+    yield ("cache_evictions_total", "counter", "Entries evicted to stay under maxsize.", labels, stats["evictions"])
+    yield ("cache_entries", "gauge", "Entries currently cached.", labels, stats["size"])
+
+POOL_SAMPLES = (
+    ("checked_out", "db_pool_checked_out", "gauge", "Connections currently checked out."),
+    ("overflow", "db_pool_overflow", "gauge", "Connections open beyond pool_size."),
+    ("checkouts", "db_pool_checkouts_total", "counter", "Connection checkouts."),
+    ("timeouts", "db_pool_timeouts_total", "counter", "Checkouts that gave up after pool_timeout."),
+    ("wait_seconds_total", "db_pool_wait_seconds_total", "counter", "Time spent waiting for a connection."),
+)
+
+def pool_samples(stats_by_bind):
+    # only the instrumented pools, see pool.pool_stats
+    for bind, stats in stats_by_bind.items():
+        for key, name, kind, help_text in POOL_SAMPLES:
+            if key in stats:
+                yield (name, kind, help_text, {"bind": bind}, stats[key])
+
+def setup_metrics(app):
+    metrics.directory = app.config['METRICS_DIR']
+    metrics.flush_seconds = app.config['METRICS_FLUSH_SECONDS']
+    if metrics.directory is not None:
+        # a worker recycled by gunicorn leaves its last requests in its file
+        atexit.register(metrics.flush, True)
+
+    @event.listens_for(Engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_start = time.perf_counter()
+
+    @event.listens_for(Engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        queries = _request_queries.get()
+        if queries is not None and context is not None:
+            queries[0] += 1
+            queries[1] += time.perf_counter() - context._metrics_start
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_start = time.perf_counter()
+        g.metrics_queries = [0, 0.0]
+        _request_queries.set(g.metrics_queries)
+        metrics.request_started()
+
+    @app.after_request
+    def record_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_request_metrics(exc):
+        if "metrics_start" not in g:
+            return
+        queries, query_seconds = g.metrics_queries
+        _request_queries.set(None)
+        metrics.request_finished(
+            request.endpoint or "unmatched",
+            request.method,
+            g.get("metrics_status", 500),
+            time.perf_counter() - g.metrics_start,
+            queries,
+            query_seconds,
+        )
+        metrics.flush()
@@ -1,11 +1,17 @@
 from flask_sqlalchemy import SQLAlchemy
+from replicas import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 # DEFINIMOS NUESTRAS TABLAS Y LAS RELACIONES ENTRE ELLAS, AÑADIENDO LOS ATRIBUTOS CORRESPONDIENTES:
 
 class Favorites(db.Model):
     __tablename__ = 'favorites'
+    __table_args__ = (
+        db.Index('ix_favorites_user_id_planets_id', 'user_id', 'planets_id', unique=True),
+        db.Index('ix_favorites_user_id_characters_id', 'user_id', 'characters_id', unique=True),
+        db.Index('ix_favorites_user_id_starships_id', 'user_id', 'starships_id', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     characters_id = db.Column(db.Integer, db.ForeignKey('characters.id'))
@@ -28,6 +34,15 @@ class Favorites(db.Model):
             "starships_id": self.starships_id,
         }
 
+    def serialize_expanded(self):
+        # load the relationships with selectinload/joinedload before calling this
+        return dict(
+            self.serialize(),
+            character=self.character.serialize() if self.character else None,
+            planet=self.planet.serialize() if self.planet else None,
+            starship=self.starship.serialize() if self.starship else None,
+        )
+
 class User(db.Model):
     __tablename__ = 'user'
     id = db.Column(db.Integer, primary_key=True)
@@ -50,13 +65,15 @@ class User(db.Model):
 
 class Characters(db.Model):
     __tablename__ = 'characters'
+    filterable_columns = ('name', 'height', 'mass', 'hair_color', 'eye_color', 'gender', 'birth_year')
+    sortable_columns = ('id', 'name', 'height', 'mass')
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(250), nullable=False)
+    name = db.Column(db.String(250), nullable=False, index=True)
     height = db.Column(db.Integer, nullable=False)
     mass = db.Column(db.Integer, nullable=False)
     hair_color = db.Column(db.String(250), nullable=False)
     eye_color = db.Column(db.String(250), nullable=False)
-    gender = db.Column(db.String(250), nullable=False)
+    gender = db.Column(db.String(250), nullable=False, index=True)
     birth_year = db.Column(db.String(250), nullable=False)
 
     def __repr__(self):
@@ -76,9 +93,11 @@ class Characters(db.Model):
 
 class Planets(db.Model):
     __tablename__ = 'planets'
+    filterable_columns = ('name', 'climate', 'population', 'orbital_period', 'rotation_period', 'diameter')
+    sortable_columns = ('id', 'name', 'population', 'orbital_period', 'rotation_period', 'diameter')
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(250), nullable=False)
-    climate = db.Column(db.String(250), nullable=False)
+    name = db.Column(db.String(250), nullable=False, index=True)
+    climate = db.Column(db.String(250), nullable=False, index=True)
     population = db.Column(db.Integer, nullable=False)
     orbital_period = db.Column(db.Integer, nullable=False)
     rotation_period = db.Column(db.Integer, nullable=False)
@@ -100,9 +119,11 @@ class Planets(db.Model):
 
 class Starships(db.Model):
     __tablename__ = 'starships'
+    filterable_columns = ('name', 'manufacturer', 'crew', 'passengers', 'consumables', 'cost_in_credits')
+    sortable_columns = ('id', 'name', 'crew', 'passengers', 'cost_in_credits')
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(250), nullable=False)
-    manufacturer = db.Column(db.String(250), nullable=False)
+    name = db.Column(db.String(250), nullable=False, index=True)
+    manufacturer = db.Column(db.String(250), nullable=False, index=True)
     crew = db.Column(db.Integer, nullable=False)
     passengers = db.Column(db.Integer, nullable=False)
     consumables = db.Column(db.String(250), nullable=False)
@@ -121,3 +142,17 @@ class Starships(db.Model):
             "consumables": self.consumables,
             "cost_in_credits": self.cost_in_credits,
         }
+
+class TableVersion(db.Model):
+    __tablename__ = 'table_version'
+    name = db.Column(db.String(250), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<TableVersion %r>' % self.name
+
+    def serialize(self):
+        return {
+            "name": self.name,
+            "version": self.version,
+        }
@@ -0,0 +1,92 @@
+"""
+SQLAlchemy engine options driven by environment variables, and a QueuePool
+that measures how long requests wait to check out a connection
+"""
+import os
+import threading
+import time
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+class PoolMetrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record(self, waited, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+class InstrumentedQueuePool(QueuePool):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def connect(self):
+        # the wait covers queueing for a free connection, opening a new one
+        # and the pre-ping
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            self.metrics.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.metrics.record(time.perf_counter() - start)
+        return connection
+
+    def stats(self):
+        metrics = self.metrics
+        return {
+            "size": self.size(),
+            "checked_in": self.checkedin(),
+            "checked_out": self.checkedout(),
+            "overflow": max(self.overflow(), 0),
+            "checkouts": metrics.checkouts,
+            "timeouts": metrics.timeouts,
+            "wait_seconds_total": round(metrics.wait_seconds_total, 6),
+            "wait_seconds_max": round(metrics.wait_seconds_max, 6),
+        }
+
+def env_flag(name, default):
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
+
+def engine_options_from_env(database_uri):
+    url = make_url(database_uri)
+    options = {
+        "pool_pre_ping": env_flag("DB_POOL_PRE_PING", "1"),
+        # below the idle timeout of the Postgres proxy, so we never hand out
+        # a connection it already dropped
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+    }
+    # an in-memory SQLite database lives in a single connection, keep its default pool
+    if not (url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")):
+        options.update(
+            poolclass=InstrumentedQueuePool,
+            pool_size=int(os.getenv("DB_POOL_SIZE", 5)),
+            max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+            pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", 30)),
+        )
+
+    statement_timeout = os.getenv("DB_STATEMENT_TIMEOUT_MS")
+    if statement_timeout:
+        if url.get_backend_name() == "postgresql":
+            options["connect_args"] = {"options": "-c statement_timeout=%d" % int(statement_timeout)}
+        elif url.get_backend_name() == "mysql":
+            options["connect_args"] = {"init_command": "SET SESSION max_execution_time=%d" % int(statement_timeout)}
+    return options
+
+def pool_stats(engines):
+    # engines is db.engines, {bind key: engine}; None is the default bind
+    return {
+        key or "default": engine.pool.stats() if isinstance(engine.pool, InstrumentedQueuePool) else {"status": engine.pool.status()}
+        for key, engine in engines.items()
+    }
@@ -0,0 +1,145 @@
+"""
+Read-replica routing: SELECTs made by routes marked @read_only go to one of
+the DATABASE_READ_URL replicas, everything else (writes, flushes, the table
+version bumps, unmarked routes) stays on the primary.
+
+A client that just wrote gets a short-lived cookie and keeps reading from the
+primary until it expires, so it always sees its own writes whatever the
+replication lag is. API clients that drop cookies are pinned by the identity
+of their JWT as well, in the shared cache store when there is one so every
+worker knows about it.
+"""
+import hashlib
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import g, request, current_app, has_app_context, has_request_context
+from flask_jwt_extended import decode_token
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql import Select
+
+STICKY_COOKIE = "db_primary_until"
+
+def replica_binds(read_urls, engine_options):
+    # one SQLALCHEMY_BINDS entry per replica, named replica_0, replica_1...
+    binds = {}
+    for index, url in enumerate(read_urls):
+        url = url.strip().replace("postgres://", "postgresql://")
+        binds["replica_%d" % index] = {"url": url, **engine_options(url)}
+    return binds
+
+def replica_keys(engines):
+    return [key for key in engines if key is not None and key.startswith("replica_")]
+
+class RoutingSession(Session):
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and isinstance(clause, Select) and not self._flushing
+                and has_app_context() and g.get("db_read_only")):
+            engines = self._db.engines
+            # one replica for the whole request, so it reads a single snapshot
+            if "db_replica" not in g:
+                keys = replica_keys(engines)
+                g.db_replica = random.choice(keys) if keys else None
+            if g.db_replica is not None:
+                return engines[g.db_replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+class PinnedIdentities:
+    # JWT identities reading from the primary until a deadline
+
+    def __init__(self):
+        self.store = None  # the shared cache store, None keeps them in process
+        self._local = {}
+        self._lock = threading.Lock()
+
+    def _key(self, identity):
+        return "sticky:" + hashlib.sha1(identity.encode()).hexdigest()
+
+    def pin(self, identity, seconds):
+        key = self._key(identity)
+        if self.store is not None:
+            self.store.set(key, b"1", seconds)
+            return
+        now = time.time()
+        with self._lock:
+            if len(self._local) > 10000:
+                self._local = {key: until for key, until in self._local.items() if until > now}
+            self._local[key] = now + seconds
+
+    def pinned(self, identity):
+        key = self._key(identity)
+        if self.store is not None:
+            return self.store.get_many([key])[0] is not None
+        with self._lock:
+            return self._local.get(key, 0) > time.time()
+
+pinned_identities = PinnedIdentities()
+
+def has_replicas():
+    return bool(replica_keys(current_app.config.get('SQLALCHEMY_BINDS') or {}))
+
+def request_identity():
+    # the identity of a valid bearer token, without requiring one
+    header = request.headers.get("Authorization", "")
+    if not header.startswith("Bearer "):
+        return None
+    try:
+        return str(decode_token(header[len("Bearer "):])["sub"])
+    except Exception:
+        return None
+
+def sticky_to_primary():
+    if not has_replicas():
+        return False
+    try:
+        if float(request.cookies.get(STICKY_COOKIE, 0)) > time.time():
+            return True
+    except ValueError:
+        pass
+    identity = request_identity()
+    return identity is not None and pinned_identities.pinned(identity)
+
+def read_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = not sticky_to_primary()
+        return view(*args, **kwargs)
+    return wrapper
+
+@contextmanager
+def on_primary():
+    # reads whose result outlives the request (caches, the search index) must
+    # not come from a replica: one behind the last commit would put back what
+    # that commit invalidated, for every client and until it expires
+    if not has_app_context():
+        yield
+        return
+    read_only = g.get("db_read_only", False)
+    g.db_read_only = False
+    try:
+        yield
+    finally:
+        g.db_read_only = read_only
+
+def mark_write(touched):
+    # on_commit subscriber: the request wrote something, pin the client
+    if has_request_context():
+        g.db_read_only = False
+        g.db_wrote = True
+
+def setup_replicas(app, store=None):
+    pinned_identities.store = store
+
+    @app.after_request
+    def set_sticky_cookie(response):
+        if g.get("db_wrote") and has_replicas():
+            seconds = current_app.config['REPLICA_STICKY_SECONDS']
+            response.set_cookie(STICKY_COOKIE, "%.3f" % (time.time() + seconds),
+                                max_age=seconds, httponly=True, samesite="Lax")
+            identity = request_identity()
+            if identity is not None:
+                pinned_identities.pin(identity, seconds)
+        return response
@@ -0,0 +1,352 @@
+"""
+In-memory name index behind /search, over characters, planets and starships.
+Prefix matches come from the positions sorted by name (bisect), substring
+matches from a trigram index, so a lookup never scans the tables with
+LIKE '%q%'.
+
+What a build produces is kept in flat arrays and two big strings that are
+never written afterwards: built in the gunicorn master before forking, the
+workers share it copy-on-write. Changes made after the build go to a small
+overlay on top of it until the next rebuild, which runs on a background
+thread while searches keep using the current state.
+"""
+import gc
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import defaultdict
+from itertools import accumulate, chain
+from flask import current_app, g, has_request_context
+from versions import table_version
+from replicas import on_primary
+
+def trigrams(text):
+    return {text[index:index + 3] for index in range(len(text) - 2)}
+
+def pack(texts):
+    # one string plus offsets instead of a str object per name
+    return "".join(texts), array("L", accumulate(map(len, texts), initial=0))
+
+def search_query_budget():
+    # a warm index answers without queries; what it loaded on the way (a
+    # build, a version check, reloading written rows) is added by spend()
+    return g.get("search_index_queries", 0)
+
+def spend(queries):
+    if has_request_context():
+        g.search_index_queries = g.get("search_index_queries", 0) + queries
+
+class _State:
+    # everything a search reads, rebuilt as a whole and swapped in one go
+
+    def __init__(self, kinds, versions, kind_of, ids, names, bounds):
+        self.kinds = kinds      # kind_of value -> kind
+        self.versions = versions
+        self.built_at = time.monotonic()
+        self.size = len(names)
+        self.kind_of = kind_of  # position -> index in kinds
+        self.ids = ids          # position -> id, ascending within each kind
+        self.bounds = bounds    # kind -> (first position, last position + 1)
+        lowered = [name.lower() for name in names]
+        self.names, self.name_offsets = pack(names)
+        self.lowered, self.lowered_offsets = pack(lowered)
+        self.order = array("I", sorted(range(self.size), key=lowered.__getitem__))
+        self.trigrams = {}
+        for position, text in enumerate(lowered):
+            for trigram in trigrams(text):
+                posting = self.trigrams.get(trigram)
+                if posting is None:
+                    posting = self.trigrams[trigram] = array("I")
+                posting.append(position)
+        self.dead = bytearray(self.size)
+
+        # rows written after the build, positions from self.size on
+        self.extra = []             # (kind, id, name, lowered), None once removed
+        self.extra_positions = {}   # (kind, id) -> position
+        self.extra_sorted = []      # (lowered name, position)
+        self.extra_trigrams = defaultdict(list)
+        self.changes = 0
+
+    def lowered_at(self, position):
+        if position < self.size:
+            return self.lowered[self.lowered_offsets[position]:self.lowered_offsets[position + 1]]
+        return self.extra[position - self.size][3]
+
+    def entry(self, position):
+        if position < self.size:
+            name = self.names[self.name_offsets[position]:self.name_offsets[position + 1]]
+            return self.kinds[self.kind_of[position]], self.ids[position], name
+        return self.extra[position - self.size][:3]
+
+    def alive(self, position):
+        if position < self.size:
+            return not self.dead[position]
+        return self.extra[position - self.size] is not None
+
+    def find(self, kind, entity_id):
+        position = self.extra_positions.get((kind, entity_id))
+        if position is not None:
+            return position
+        start, end = self.bounds.get(kind, (0, 0))
+        index = bisect_left(self.ids, entity_id, start, end)
+        if index < end and self.ids[index] == entity_id and not self.dead[index]:
+            return index
+        return None
+
+    def add(self, kind, entity_id, name):
+        position = self.size + len(self.extra)
+        lowered = name.lower()
+        self.extra.append((kind, entity_id, name, lowered))
+        self.extra_positions[(kind, entity_id)] = position
+        insort(self.extra_sorted, (lowered, position))
+        for trigram in trigrams(lowered):
+            self.extra_trigrams[trigram].append(position)
+        self.changes += 1
+
+    def remove(self, kind, entity_id):
+        position = self.find(kind, entity_id)
+        if position is None:
+            return
+        if position < self.size:
+            self.dead[position] = 1
+        else:
+            del self.extra_positions[(kind, entity_id)]
+            self.extra[position - self.size] = None
+        self.changes += 1
+
+    def prefixed(self, q):
+        # live positions whose name starts with q, built ones first
+        index = bisect_left(self.order, q, key=self.lowered_at)
+        while index < self.size and self.lowered_at(self.order[index]).startswith(q):
+            if not self.dead[self.order[index]]:
+                yield self.order[index]
+            index += 1
+        index = bisect_left(self.extra_sorted, (q,))
+        while index < len(self.extra_sorted) and self.extra_sorted[index][0].startswith(q):
+            if self.alive(self.extra_sorted[index][1]):
+                yield self.extra_sorted[index][1]
+            index += 1
+
+    def containing(self, q):
+        # live positions sharing q's rarest trigram, to be checked with `in`
+        def posting_size(trigram):
+            return len(self.trigrams.get(trigram, ())) + len(self.extra_trigrams.get(trigram, ()))
+        trigram = min(trigrams(q), key=posting_size)
+        for position in chain(self.trigrams.get(trigram, ()), self.extra_trigrams.get(trigram, ())):
+            if self.alive(position):
+                yield position
+
+class NameIndex:
+
+    def __init__(self, models):
+        self.models = models  # kind -> model, e.g. {"planet": Planets}
+        self.kinds = {model: kind for kind, model in models.items()}
+        self.scan_limit = 2000
+        self.rebuild_seconds = 300
+        self.overlay_limit = 10000
+        self._state = None
+        self._dirty = {}
+        self._building = False
+        self._replay = {}
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._builder = None
+
+    def build(self, versions=None):
+        # millions of small acyclic objects: the cyclic GC would only keep
+        # rescanning them while the index is being filled
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with on_primary():
+                return self._load(versions)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def _load(self, versions):
+        kinds = list(self.models)
+        kind_of, ids, names, bounds = array("B"), array("q"), [], {}
+        if versions is None:
+            spend(len(self.models))
+            versions = {kind: table_version(model) for kind, model in self.models.items()}
+        spend(len(self.models))
+        for kind_index, (kind, model) in enumerate(self.models.items()):
+            start = len(ids)
+            query = model.query.with_entities(model.id, model.name).order_by(model.id)
+            for entity_id, name in query.yield_per(10000):
+                kind_of.append(kind_index)
+                ids.append(entity_id)
+                names.append(name)
+            bounds[kind] = (start, len(ids))
+        return _State(kinds, versions, kind_of, ids, names, bounds)
+
+    def _merge_dirty(self, kind, ids):
+        # None reloads the whole table, and so does a change set too big for
+        # the overlay: a rebuild is cheaper than inserting it row by row
+        current = self._dirty.get(kind, set())
+        if ids is None or current is None or len(current) + len(ids) > self.overlay_limit:
+            self._dirty[kind] = None
+        else:
+            self._dirty[kind] = current | set(ids)
+
+    def mark_touched(self, touched):
+        # subscribed to the commit hook: we can't query from there, the rows
+        # are reloaded on the next search
+        with self._lock:
+            for model, ids in touched.items():
+                kind = self.kinds.get(model)
+                if kind is not None:
+                    self._merge_dirty(kind, ids)
+
+    def _apply_dirty(self):
+        # the rows are loaded without holding _lock, searches go on meanwhile;
+        # loads are serialized by _load_lock, so one that took a row later
+        # also applies it later and a newer name is never overwritten
+        if not self._load_lock.acquire(blocking=False):
+            return  # another search is loading them
+        try:
+            with self._lock:
+                # whole tables wait for the rebuild, it's the one running already
+                if not self._dirty or None in self._dirty.values():
+                    return
+                dirty, self._dirty = self._dirty, {}
+                if self._building:
+                    # the state being built may have read these rows before they
+                    # were written, they are applied to it again once it is swapped in
+                    self._replay.update((kind, self._replay.get(kind, set()) | ids) for kind, ids in dirty.items())
+            loaded = {}
+            try:
+                for kind, ids in dirty.items():
+                    model = self.models[kind]
+                    spend(1)
+                    with on_primary():
+                        loaded[kind] = model.query.with_entities(model.id, model.name).filter(model.id.in_(ids)).all()
+            except Exception:
+                with self._lock:
+                    for kind, ids in dirty.items():
+                        self._merge_dirty(kind, ids)
+                raise
+            with self._lock:
+                state = self._state
+                for kind, ids in dirty.items():
+                    for entity_id in ids:
+                        state.remove(kind, entity_id)
+                    for entity_id, name in loaded[kind]:
+                        state.add(kind, entity_id, name)
+        finally:
+            self._load_lock.release()
+
+    def _rebuild(self, versions=None):
+        # called with _build_lock held; searches keep using the current state
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            self._building = True
+        state = None
+        try:
+            state = self.build(versions)
+        finally:
+            with self._lock:
+                self._building = False
+                replay, self._replay = self._replay, {}
+                if state is None:
+                    # nothing was rebuilt, the changes are still pending
+                    replay.update(dirty)
+                else:
+                    self._state = state
+                for kind, ids in replay.items():
+                    self._merge_dirty(kind, ids)
+
+    def _current_state(self):
+        if self._state is None:
+            with self._build_lock:
+                if self._state is None:
+                    self._rebuild()
+            return self._state
+
+        state = self._state
+        with self._lock:
+            outgrown = None in self._dirty.values() or state.changes > self.overlay_limit
+        expired = time.monotonic() - state.built_at > self.rebuild_seconds
+        if (outgrown or expired) and self._build_lock.acquire(blocking=False):
+            # a rebuild takes seconds on big tables: it runs on its own thread and
+            # is swapped in when done, this search and the next ones use the
+            # current state meanwhile
+            state.built_at = time.monotonic()
+            self._builder = threading.Thread(target=self._refresh, args=(current_app._get_current_object(), outgrown),
+                                             name="search-index", daemon=True)
+            try:
+                self._builder.start()
+            except Exception:
+                self._build_lock.release()
+                raise
+        return self._state
+
+    def _refresh(self, app, outgrown):
+        # on the builder thread, with _build_lock held. Writes made by other
+        # workers only reach us through a rebuild, which is skipped when none
+        # of the tables moved
+        try:
+            with app.app_context():
+                if outgrown:
+                    self._rebuild()
+                    return
+                with on_primary():
+                    versions = {kind: table_version(model) for kind, model in self.models.items()}
+                if versions != self._state.versions:
+                    self._rebuild(versions)
+        except Exception:
+            app.logger.exception("search index not rebuilt, searches keep using the current one")
+        finally:
+            self._build_lock.release()
+
+    def join(self, timeout=None):
+        # waits for a background rebuild, for tests and shutdown
+        builder = self._builder
+        if builder is not None:
+            builder.join(timeout)
+
+    def clear(self):
+        # drops the index, the next search builds it again
+        with self._build_lock, self._lock:
+            self._state = None
+            self._dirty = {}
+
+    def warm(self):
+        # builds the index now instead of on the first search
+        self._current_state()
+
+    def search(self, q, limit):
+        q = q.strip().lower()
+        self._current_state()
+        self._apply_dirty()
+        with self._lock:
+            state = self._state
+
+            # 0 exact, 1 prefix, 2 prefix of a later word, 3 substring
+            candidates = {}
+            for position in state.prefixed(q):
+                if len(candidates) >= self.scan_limit:
+                    break
+                candidates[position] = 0 if state.lowered_at(position) == q else 1
+
+            if len(q) >= 3:
+                scanned = 0
+                for position in state.containing(q):
+                    if scanned >= self.scan_limit:
+                        break
+                    scanned += 1
+                    lowered = state.lowered_at(position)
+                    if position not in candidates and q in lowered:
+                        candidates[position] = 2 if (" " + q) in lowered or ("-" + q) in lowered else 3
+
+            best = heapq.nsmallest(limit, candidates, key=lambda position: (
+                candidates[position], len(state.lowered_at(position)), state.lowered_at(position)))
+            results = []
+            for position in best:
+                kind, entity_id, name = state.entry(position)
+                results.append({"type": kind, "id": entity_id, "name": name})
+            return results
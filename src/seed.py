@@ -0,0 +1,209 @@
+"""
+`flask seed`: deterministic synthetic data (users, planets, characters,
+starships and favorites) loaded in bulk, with COPY FROM STDIN on Postgres and
+chunked executemany on a pragma-tuned connection on SQLite.
+
+    $ flask seed --users 10000 --catalog 1000000 --favorites 10000000 --truncate
+
+Rows get explicit ids 1..N so the favorites can point at them without looking
+anything up; the same --seed always produces the same rows.
+"""
+import csv
+import io
+import random
+import time
+import click
+from sqlalchemy import create_engine, func, select, update
+from sqlalchemy.pool import NullPool
+from models import db, User, Planets, Characters, Starships, Favorites, TableVersion
+
+CLIMATES = ("arid", "temperate", "frozen", "murky", "tropical", "arid, temperate")
+EYE_COLORS = ("blue", "brown", "red", "yellow", "black")
+HAIR = ("brown", "black", "blond", "white", "none")
+GENDERS = ("male", "female", "n/a")
+MANUFACTURERS = ("Kuat Drive Yards", "Corellian Engineering Corporation", "Sienar Fleet Systems", "Incom Corporation")
+PASSWORD = "password"
+
+COLUMNS = {
+    User: ("id", "first_name", "last_name", "email", "password"),
+    Planets: ("id", "name", "climate", "population", "orbital_period", "rotation_period", "diameter"),
+    Characters: ("id", "name", "height", "mass", "hair_color", "eye_color", "gender", "birth_year"),
+    Starships: ("id", "name", "manufacturer", "crew", "passengers", "consumables", "cost_in_credits"),
+    Favorites: ("id", "user_id", "characters_id", "planets_id", "starships_id"),
+}
+
+def users_rows(count, rng):
+    for i in range(1, count + 1):
+        yield (i, "User", str(i), "user%d@seed.dev" % i, PASSWORD)
+
+def planets_rows(count, rng):
+    for i in range(1, count + 1):
+        yield (i, "Planet %d" % i, rng.choice(CLIMATES), rng.randrange(10 ** 9),
+               rng.randrange(1, 5000), rng.randrange(1, 100), rng.randrange(1000, 200000))
+
+def characters_rows(count, rng):
+    for i in range(1, count + 1):
+        yield (i, "Character %d" % i, rng.randrange(60, 260), rng.randrange(20, 200),
+               rng.choice(HAIR), rng.choice(EYE_COLORS), rng.choice(GENDERS), "%dBBY" % rng.randrange(1000))
+
+def starships_rows(count, rng):
+    for i in range(1, count + 1):
+        yield (i, "Starship %d" % i, rng.choice(MANUFACTURERS), rng.randrange(1, 50000),
+               rng.randrange(0, 100000), "%d months" % rng.randrange(1, 60), rng.randrange(10 ** 4, 10 ** 9))
+
+def favorites_rows(count, users):
+    # favorite n belongs to user k % users and points to item k // users + 1
+    # of kind n % 3, so the (user, item) pairs the unique indexes check never repeat
+    for index in range(count):
+        k, kind = divmod(index, 3)
+        item = k // users + 1
+        yield (index + 1, k % users + 1,
+               item if kind == 1 else None, item if kind == 0 else None, item if kind == 2 else None)
+
+def generate(volumes, seed):
+    # one generator per table, in load order (favorites last, they reference the rest)
+    rng = random.Random(seed)
+    return [
+        (User, volumes["users"], users_rows(volumes["users"], rng)),
+        (Planets, volumes["catalog"], planets_rows(volumes["catalog"], rng)),
+        (Characters, volumes["catalog"], characters_rows(volumes["catalog"], rng)),
+        (Starships, volumes["catalog"], starships_rows(volumes["catalog"], rng)),
+        (Favorites, volumes["favorites"], favorites_rows(volumes["favorites"], max(volumes["users"], 1))),
+    ]
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class CSVStream(io.TextIOBase):
+    # file-like over the row generator for copy_expert, rendered a chunk at a
+    # time so 10M rows never sit in memory
+    def __init__(self, rows, chunk_size):
+        self._chunks = chunked(rows, chunk_size)
+        self._buffer = ""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            out = io.StringIO()
+            csv.writer(out, lineterminator="\n").writerows(chunk)
+            self._buffer += out.getvalue()
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+def copy_load(connection, table, columns, rows, chunk_size):
+    cursor = connection.cursor()
+    # empty unquoted fields are NULL in csv mode
+    cursor.copy_expert("COPY %s (%s) FROM STDIN WITH (FORMAT csv)" % (table, ", ".join(columns)),
+                       CSVStream(rows, chunk_size))
+    # the ids were explicit, move the sequence past them
+    cursor.execute("SELECT setval(pg_get_serial_sequence('%s', 'id'), coalesce(max(id), 1)) FROM %s" % (table, table))
+
+def executemany_load(connection, table, columns, rows, chunk_size, placeholder):
+    statement = "INSERT INTO %s (%s) VALUES (%s)" % (table, ", ".join(columns), ", ".join([placeholder] * len(columns)))
+    cursor = connection.cursor()
+    for chunk in chunked(rows, chunk_size):
+        cursor.executemany(statement, chunk)
+
+def check_volumes(volumes):
+    if volumes["favorites"] and volumes["favorites"] > 3 * volumes["users"] * volumes["catalog"]:
+        raise ValueError("not enough users and catalog rows for %d distinct favorites" % volumes["favorites"])
+
+def load(engine, volumes, seed=1977, chunk_size=50000, echo=None):
+    """Bulk loads the generated rows into empty tables, returns {table: (rows, seconds)}"""
+    check_volumes(volumes)
+
+    # a connection of its own, the pragmas and the dropped indexes must not
+    # leak into the pooled connections the app uses
+    engine = create_engine(engine.url, poolclass=NullPool)
+    dialect = engine.dialect
+    use_copy = dialect.name == "postgresql" and dialect.driver == "psycopg2"
+    placeholder = "?" if dialect.paramstyle == "qmark" else "%s"
+    quote = dialect.identifier_preparer.quote
+    timings = {}
+    try:
+        for model, count, rows in generate(volumes, seed):
+            if count == 0:
+                continue
+            indexes = list(model.__table__.indexes)
+            start = time.perf_counter()
+            with engine.begin() as connection:
+                # building the secondary indexes once at the end is much
+                # cheaper than maintaining them row by row
+                for index in indexes:
+                    index.drop(connection)
+                raw = connection.connection.driver_connection
+                if dialect.name == "sqlite":
+                    raw.execute("PRAGMA synchronous=OFF")
+                    raw.execute("PRAGMA cache_size=-262144")
+                    raw.execute("PRAGMA temp_store=MEMORY")
+                table = quote(model.__tablename__)
+                columns = [quote(column) for column in COLUMNS[model]]
+                if use_copy:
+                    copy_load(raw, table, columns, rows, chunk_size)
+                else:
+                    executemany_load(raw, table, columns, rows, chunk_size, placeholder)
+                for index in indexes:
+                    index.create(connection)
+                # ETags and cached stats must notice the new rows
+                connection.execute(
+                    update(TableVersion.__table__)
+                    .where(TableVersion.__table__.c.name == model.__tablename__)
+                    .values(version=TableVersion.__table__.c.version + 1)
+                )
+            timings[model.__tablename__] = (count, time.perf_counter() - start)
+            if echo is not None:
+                seconds = timings[model.__tablename__][1]
+                echo("%-10s %12s rows in %7.1fs (%s rows/s)" % (
+                    model.__tablename__, "{:,}".format(count), seconds, "{:,}".format(int(count / seconds))))
+    finally:
+        engine.dispose()
+    return timings
+
+def setup_seed_command(app):
+
+    @app.cli.command("seed")
+    @click.option("--users", default=1000, show_default=True)
+    @click.option("--catalog", default=10000, show_default=True, help="Planets, characters and starships each.")
+    @click.option("--favorites", default=20000, show_default=True)
+    @click.option("--seed", "seed", default=1977, show_default=True, help="Same seed, same rows.")
+    @click.option("--chunk-size", default=50000, show_default=True)
+    @click.option("--truncate", is_flag=True, help="Delete the existing rows first.")
+    def seed_command(users, catalog, favorites, seed, chunk_size, truncate):
+        """Fill the database with deterministic synthetic data."""
+        volumes = {"users": users, "catalog": catalog, "favorites": favorites}
+        try:
+            check_volumes(volumes)
+        except ValueError as error:
+            raise click.ClickException(str(error))
+
+        models = (Favorites, User, Planets, Characters, Starships)
+        if truncate:
+            with db.engine.begin() as connection:
+                for model in models:
+                    connection.execute(model.__table__.delete())
+        else:
+            existing = {model.__tablename__: db.session.scalar(select(func.count()).select_from(model)) for model in models}
+            if any(existing.values()):
+                raise click.ClickException("the tables are not empty (%s), use --truncate" % ", ".join(
+                    "%s=%d" % item for item in existing.items() if item[1]))
+            db.session.rollback()
+
+        start = time.perf_counter()
+        timings = load(db.engine, volumes, seed, chunk_size, click.echo)
+        total = sum(count for count, seconds in timings.values())
+        elapsed = time.perf_counter() - start
+        click.echo("%-10s %12s rows in %7.1fs (%s rows/s)" % ("total", "{:,}".format(total), elapsed, "{:,}".format(int(total / elapsed))))
@@ -0,0 +1,66 @@
+"""
+Row-to-dict functions generated once per model (and per field selection) from
+its columns, and an orjson backed JSON provider for Flask when orjson is installed
+"""
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_serializers = {}
+
+def compile_serializer(name, fields, tuples=False):
+    # generates `def serialize(row): return {"id": row.id, "name": row.name, ...}`
+    # so a row is turned into a dict by a single dict display, with no method
+    # call or attribute lookup on the model per column
+    if tuples:
+        items = ", ".join("%r: row[%d]" % (field, index) for index, field in enumerate(fields))
+    else:
+        items = ", ".join("%r: row.%s" % (field, field) for field in fields)
+    source = "def serialize(row):\n    return {%s}\n" % items
+    namespace = {}
+    exec(compile(source, "<serializer %s>" % name, "exec"), namespace)
+    return namespace["serialize"]
+
+def serializer_for(model, fields=None, tuples=False):
+    # fields defaults to every column of the table, which is what the
+    # hand written serialize() of the catalog models and User return
+    if fields is None:
+        fields = [column.name for column in model.__table__.columns]
+    key = (model, tuple(fields), tuples)
+    serialize = _serializers.get(key)
+    if serialize is None:
+        serialize = _serializers[key] = compile_serializer(model.__name__, fields, tuples)
+    return serialize
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    # dates, dataclasses and anything else orjson doesn't know go through
+    # the same default() as the stdlib provider, so the output is the same
+    passthrough = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS if orjson else 0
+
+    def _options(self, indent=False):
+        option = self.passthrough | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=self._options()).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        body = orjson.dumps(obj, default=self.default, option=self._options(indent))
+        return self._app.response_class(body + b"\n", mimetype=self.mimetype)
+
+def setup_json(app):
+    if orjson is not None and app.config['JSON_BACKEND'] == "orjson":
+        app.json = ORJSONProvider(app)
@@ -0,0 +1,405 @@
+"""
+Entity cache shared by every worker, for the catalog payloads (planets,
+characters, starships) that all of them serve:
+
+    CACHE_BACKEND=memory  one EntityCache per worker (the default)
+    CACHE_BACKEND=shm     a fixed size hash table in a memory mapped file
+                          (CACHE_SHM_PATH), shared by the workers of a host
+    CACHE_BACKEND=redis   a Redis server (CACHE_REDIS_URL), shared by every
+                          host; redis-py is only imported for this backend and
+                          CACHE_REDIS_URL=memory:// swaps in LocalRedis
+
+A write invalidates the entry in the shared store itself, so the next read of
+any worker misses. Users (their payload has the password) never go to the
+store: each worker keeps them in process, checked against the shared tokens
+of the user table, so a user deleted or changed through one worker is a miss
+for all of them. The verified token identities of auth.py are shared, in
+their own "identity" namespace of the same store.
+
+Keys are namespaced per deployment (CACHE_NAMESPACE, by default a hash of the
+database URL), so deployments sharing a Redis server never read each other's
+entries, and a restart invalidates its own namespace instead of wiping the
+store.
+"""
+import fcntl
+import fnmatch
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from cache import EntityCache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def dumps(payload):
+    return orjson.dumps(payload) if orjson else json.dumps(payload, separators=(",", ":")).encode()
+
+def loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+############################################# SHARED MEMORY
+
+class MmapStore:
+    # open addressing over `slots` fixed size slots, a key lives in one of
+    # the PROBES slots after its hash. Writers take a lock on the file (and a
+    # thread lock, file locks are per process); readers don't lock, every slot
+    # has a sequence number that is odd while it is being written and a read
+    # that saw it change is retried (a seqlock)
+    name = "shm"
+    MAGIC = b"SWCACHE1"
+    HEADER = struct.Struct("<8sII")
+    SLOT = struct.Struct("<QQdHI")  # seq, key hash, expires at, key length, value length
+    PROBES = 8
+
+    def __init__(self, path, slots=16384, slot_size=1024):
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.capacity = slot_size - self.SLOT.size
+        self._lock = threading.Lock()
+        size = self.HEADER.size + slots * slot_size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        with self._locked():
+            if os.fstat(self._fd).st_size != size:
+                os.ftruncate(self._fd, size)
+            self._map = mmap.mmap(self._fd, size)
+            magic, stored_slots, stored_size = self.HEADER.unpack_from(self._map, 0)
+            if (magic, stored_slots, stored_size) != (self.MAGIC, slots, slot_size):
+                # a new file, or one laid out for another configuration
+                self._map[:] = bytes(size)
+                self.HEADER.pack_into(self._map, 0, self.MAGIC, slots, slot_size)
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def _hash(self, key):
+        # hash() is salted per process, the workers must agree on the slot
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+
+    def _offsets(self, key_hash):
+        start = key_hash % self.slots
+        for probe in range(self.PROBES):
+            yield self.HEADER.size + ((start + probe) % self.slots) * self.slot_size
+
+    def _read(self, offset):
+        for attempt in range(100):
+            seq = self.SLOT.unpack_from(self._map, offset)[0]
+            if seq & 1:
+                continue
+            header = self.SLOT.unpack_from(self._map, offset)
+            end = offset + self.SLOT.size + min(header[3] + header[4], self.capacity)
+            data = self._map[offset + self.SLOT.size:end]
+            if self.SLOT.unpack_from(self._map, offset)[0] == seq == header[0]:
+                return header, data
+        # a writer killed halfway through leaves the slot odd, read it as empty
+        return (0, 0, 0.0, 0, 0), b""
+
+    def _write(self, offset, key_hash, expires, key, value):
+        seq = self.SLOT.unpack_from(self._map, offset)[0]
+        self._map[offset:offset + 8] = struct.pack("<Q", seq + 1)
+        self._map[offset + self.SLOT.size:offset + self.SLOT.size + len(key) + len(value)] = key + value
+        self.SLOT.pack_into(self._map, offset, seq + 1, key_hash, expires, len(key), len(value))
+        self._map[offset:offset + 8] = struct.pack("<Q", seq + 2)
+
+    def _find(self, key, key_hash, now):
+        for offset in self._offsets(key_hash):
+            (seq, slot_hash, expires, key_length, value_length), data = self._read(offset)
+            if slot_hash == key_hash and expires > now and data[:key_length] == key:
+                return offset, data[key_length:key_length + value_length]
+        return None, None
+
+    def get_many(self, keys):
+        now = time.time()
+        return [self._find(key.encode(), self._hash(key.encode()), now)[1] for key in keys]
+
+    def set(self, key, value, ttl=None, only_new=False):
+        key = key.encode()
+        if len(key) + len(value) > self.capacity:
+            return False
+        key_hash = self._hash(key)
+        expires = time.time() + ttl if ttl else float("inf")
+        with self._locked():
+            now = time.time()
+            offset, current = self._find(key, key_hash, now)
+            if offset is not None and only_new:
+                return False
+            if offset is None:
+                # a free or expired slot, else the one closest to expiring
+                candidates = []
+                for candidate in self._offsets(key_hash):
+                    slot_expires = self.SLOT.unpack_from(self._map, candidate)[2]
+                    candidates.append((slot_expires if slot_expires > now else 0, candidate))
+                offset = min(candidates)[1]
+            self._write(offset, key_hash, expires, key, value)
+        return True
+
+    def delete(self, key):
+        key = key.encode()
+        with self._locked():
+            offset, value = self._find(key, self._hash(key), time.time())
+            if offset is not None:
+                self._write(offset, 0, 0.0, b"", b"")
+
+    def clear(self):
+        with self._locked():
+            self._map[self.HEADER.size:] = bytes(self.slots * self.slot_size)
+
+    def size(self):
+        now = time.time()
+        live = 0
+        for slot in range(self.slots):
+            seq, key_hash, expires, key_length, value_length = self.SLOT.unpack_from(
+                self._map, self.HEADER.size + slot * self.slot_size)
+            if key_hash and expires > now:
+                live += 1
+        return live
+
+############################################# REDIS
+
+class RedisStore:
+    name = "redis"
+
+    def __init__(self, client, prefix="cache:"):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, prefix="cache:"):
+        if url.startswith("memory://"):
+            return cls(LocalRedis(), prefix)
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_BACKEND=redis needs the redis package, install it or use CACHE_BACKEND=shm")
+        return cls(redis.Redis.from_url(url), prefix)
+
+    def get_many(self, keys):
+        return self.client.mget([self.prefix + key for key in keys])
+
+    def set(self, key, value, ttl=None, only_new=False):
+        return bool(self.client.set(self.prefix + key, value, px=int(ttl * 1000) if ttl else None, nx=only_new))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def size(self):
+        return None
+
+class LocalRedis:
+    # in-process stand-in for the few redis-py calls RedisStore makes, for
+    # tests and single process runs; not shared with anything
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _live(self, name, now):
+        entry = self._data.get(name)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self._data[name]
+            return None
+        return entry
+
+    def mget(self, names):
+        now = time.monotonic()
+        with self._lock:
+            return [entry[0] if entry is not None else None for entry in (self._live(name, now) for name in names)]
+
+    def set(self, name, value, px=None, nx=False):
+        now = time.monotonic()
+        with self._lock:
+            if nx and self._live(name, now) is not None:
+                return None
+            self._data[name] = (value, now + px / 1000 if px else None)
+            return True
+
+    def delete(self, *names):
+        with self._lock:
+            return sum(self._data.pop(name, None) is not None for name in names)
+
+    def scan_iter(self, match="*"):
+        with self._lock:
+            names = list(self._data)
+        return iter(fnmatch.filter(names, match))
+
+############################################# CACHE
+
+class SharedEntityCache(EntityCache):
+    """
+    EntityCache whose entries for `models` live in a shared store.
+
+    Every model has two tokens in the store: an epoch, replaced when the
+    whole table is invalidated and stamped on every entry (an entry from
+    another epoch is a miss), and a generation, replaced on every write. A
+    reader stores what it loaded and then checks the generation it started
+    with is still there, deleting its entry otherwise: a write always commits,
+    replaces the generation and deletes the entry in that order, so a stale
+    payload never outlives the write that made it stale.
+
+    Entries of `private_models` stay in this process, stamped with the
+    (epoch, generation) read before they were loaded; only the tokens are
+    shared, and an entry whose stamp no longer matches them is a miss. Any
+    write to the table drops them in every worker, fine for tables that are
+    rarely written.
+    """
+
+    def __init__(self, store, models, maxsize=10000, ttl=300, namespace="entity", private_models=()):
+        super().__init__(maxsize, ttl)
+        self.store = store
+        self.models = set(models)
+        self.private_models = set(private_models)
+        self.namespace = namespace  # caches sharing a store keep apart by it
+
+    def _keys(self, model, entity_id=None):
+        prefix = "%s:%s:" % (self.namespace, model.__tablename__)
+        return prefix + "epoch", prefix + "generation", prefix + str(entity_id)
+
+    def _shared(self, model):
+        return model in self.models or model in self.private_models
+
+    def get(self, model, entity_id):
+        if not self._shared(model):
+            return super().get(model, entity_id)
+        return self.get_many(model, [entity_id]).get(entity_id)
+
+    def generation(self, model):
+        if not self._shared(model):
+            return super().generation(model)
+        epoch_key, generation_key, key = self._keys(model)
+        epoch, generation = self.store.get_many([epoch_key, generation_key])
+        if epoch is None or generation is None:
+            # first use, or a token was evicted: new ones, so entries stamped
+            # with a lost token can never become valid again
+            token = uuid.uuid4().hex.encode()
+            self.store.set(epoch_key, token, only_new=True)
+            self.store.set(generation_key, token, only_new=True)
+            epoch, generation = self.store.get_many([epoch_key, generation_key])
+        return epoch, generation
+
+    def _get_private(self, model, ids):
+        tokens = tuple(self.store.get_many(list(self._keys(model)[:2])))
+        found = {}
+        for entity_id in ids:
+            entry = EntityCache.get(self, model, entity_id)
+            if entry is not None and entry[0] == tokens:
+                found[entity_id] = entry[1]
+        return found
+
+    def _set_private(self, model, payloads, generation):
+        if generation is None:
+            generation = self.generation(model)
+        for entity_id, payload in payloads.items():
+            EntityCache.set(self, model, entity_id, (tuple(generation), payload))
+
+    def set(self, model, entity_id, payload, generation=None):
+        if not self._shared(model):
+            return super().set(model, entity_id, payload, generation)
+        self.set_many(model, {entity_id: payload}, generation)
+        return payload
+
+    def get_many(self, model, ids):
+        if model in self.private_models:
+            return self._get_private(model, ids)
+        if model not in self.models:
+            return super().get_many(model, ids)
+        keys = [self._keys(model, entity_id)[2] for entity_id in ids]
+        # the epoch and every entry in a single round trip
+        epoch, *entries = self.store.get_many([self._keys(model)[0]] + keys)
+        found = {}
+        for entity_id, entry in zip(ids, entries):
+            if epoch is not None and entry is not None:
+                entry_epoch, _, data = entry.partition(b"|")
+                if entry_epoch == epoch:
+                    found[entity_id] = loads(data)
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(ids) - len(found)
+        return found
+
+    def set_many(self, model, payloads, generation=None):
+        if model in self.private_models:
+            return self._set_private(model, payloads, generation)
+        if model not in self.models:
+            return super().set_many(model, payloads, generation)
+        if generation is None:
+            generation = self.generation(model)
+        epoch_key, generation_key, key = self._keys(model)
+        if generation[0] is None:
+            return
+        keys = []
+        for entity_id, payload in payloads.items():
+            keys.append(self._keys(model, entity_id)[2])
+            self.store.set(keys[-1], generation[0] + b"|" + dumps(payload), self.ttl)
+        # a write committed while the payloads were being loaded
+        if tuple(self.store.get_many([epoch_key, generation_key])) != tuple(generation):
+            for key in keys:
+                self.store.delete(key)
+
+    def invalidate(self, model, entity_id=None):
+        if model in self.private_models:
+            super().invalidate(model, entity_id)
+        elif model not in self.models:
+            return super().invalidate(model, entity_id)
+        epoch_key, generation_key, key = self._keys(model, entity_id)
+        if entity_id is None:
+            self.store.set(epoch_key, uuid.uuid4().hex.encode())
+            return
+        self.store.set(generation_key, uuid.uuid4().hex.encode())
+        self.store.delete(key)
+
+    def clear(self):
+        super().clear()
+        self.store.clear()
+
+    def stats(self):
+        stats = super().stats()
+        stats["backend"] = self.store.name
+        stats["shared_size"] = self.store.size()
+        return stats
+
+def default_shm_path(namespace):
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "starwars-entity-cache-%s" % namespace)
+
+def cache_namespace(config):
+    # two deployments pointing at the same database may share entries, any
+    # other two must not
+    if config['CACHE_NAMESPACE']:
+        return config['CACHE_NAMESPACE']
+    return hashlib.sha1(config['SQLALCHEMY_DATABASE_URI'].encode()).hexdigest()[:12]
+
+def make_cache_store(config):
+    # the store of CACHE_BACKEND, None for the in-process one
+    backend = config['CACHE_BACKEND']
+    if backend == "memory":
+        return None
+    if backend == "shm":
+        return MmapStore(config['CACHE_SHM_PATH'] or default_shm_path(cache_namespace(config)),
+                         config['CACHE_SHM_SLOTS'], config['CACHE_SHM_SLOT_SIZE'])
+    if backend == "redis":
+        return RedisStore.from_url(config['CACHE_REDIS_URL'], "cache:%s:" % cache_namespace(config))
+    raise ValueError("unknown CACHE_BACKEND %s, use memory, shm or redis" % backend)
+
+def make_entity_cache(store, shared_models, maxsize, ttl, namespace="entity", private_models=()):
+    if store is None:
+        return EntityCache(maxsize, ttl)
+    return SharedEntityCache(store, shared_models, maxsize, ttl, namespace, private_models)
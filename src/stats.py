@@ -0,0 +1,99 @@
+"""
+Aggregates behind /stats/<entity>, computed with GROUP BY in the database and
+cached per table version, so repeated dashboard loads don't touch the tables
+"""
+from sqlalchemy import case, func, select
+from cache import EntityCache
+from models import db, Characters, Planets, Starships
+from versions import table_version
+
+stats_cache = EntityCache()
+
+def setup_stats_cache(app):
+    stats_cache.maxsize = app.config['STATS_CACHE_SIZE']
+    stats_cache.ttl = app.config['STATS_CACHE_TTL']
+
+def count_by(column):
+    count = func.count().label("count")
+    rows = db.session.execute(select(column, count).group_by(column).order_by(count.desc(), column)).all()
+    return [{column.key: value, "count": total} for value, total in rows]
+
+def characters_stats():
+    return {
+        "total": db.session.scalar(select(func.count()).select_from(Characters)),
+        "by_gender": count_by(Characters.gender),
+        "by_eye_color": count_by(Characters.eye_color),
+    }
+
+def planets_stats():
+    rows = db.session.execute(
+        select(
+            Planets.climate,
+            func.count(),
+            func.sum(Planets.population),
+            func.avg(Planets.population),
+        ).group_by(Planets.climate).order_by(func.count().desc(), Planets.climate)
+    ).all()
+    return {
+        "total": sum(row[1] for row in rows),
+        "by_climate": [
+            {"climate": climate, "count": count, "population_sum": int(total), "population_avg": float(average)}
+            for climate, count, total, average in rows
+        ],
+    }
+
+def starships_stats():
+    # nearest-rank percentiles with window functions, which SQLite and
+    # Postgres both have: the p-th percentile is the smallest cost whose
+    # rank within its manufacturer is >= p * count
+    ranked = select(
+        Starships.manufacturer,
+        Starships.cost_in_credits,
+        func.row_number().over(partition_by=Starships.manufacturer, order_by=Starships.cost_in_credits).label("rank"),
+        func.count().over(partition_by=Starships.manufacturer).label("count"),
+    ).subquery()
+
+    def percentile(fraction):
+        return func.min(case((ranked.c.rank >= fraction * ranked.c.count, ranked.c.cost_in_credits)))
+
+    rows = db.session.execute(
+        select(
+            ranked.c.manufacturer,
+            func.max(ranked.c.count),
+            func.avg(ranked.c.cost_in_credits),
+            percentile(0.5),
+            percentile(0.9),
+            percentile(0.99),
+        ).group_by(ranked.c.manufacturer).order_by(func.max(ranked.c.count).desc(), ranked.c.manufacturer)
+    ).all()
+    return {
+        "total": sum(row[1] for row in rows),
+        "by_manufacturer": [
+            {
+                "manufacturer": manufacturer,
+                "count": count,
+                "cost_avg": float(average),
+                "cost_p50": p50,
+                "cost_p90": p90,
+                "cost_p99": p99,
+            }
+            for manufacturer, count, average, p50, p90, p99 in rows
+        ],
+    }
+
+STATS = {
+    "characters": (Characters, characters_stats),
+    "planets": (Planets, planets_stats),
+    "starships": (Starships, starships_stats),
+}
+
+def get_stats(entity):
+    model, compute = STATS[entity]
+    # keyed by the table version: a write made by any worker moves it, the
+    # commit hook only frees the entries this worker can't use anymore
+    version = table_version(model)
+    payload = stats_cache.get(model, version)
+    if payload is None:
+        generation = stats_cache.generation(model)
+        payload = stats_cache.set(model, version, compute(), generation)
+    return payload
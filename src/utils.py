@@ -1,4 +1,9 @@
-from flask import jsonify, url_for
+import base64
+import binascii
+import json
+from flask import jsonify, url_for, request, current_app, Response, stream_with_context
+from sqlalchemy import and_, or_, BigInteger, Integer
+from serializers import serializer_for
 
 class APIException(Exception):
     status_code = 400
@@ -15,13 +20,140 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+def integer_in_range(column, value):
+    # what the column can store: Integer is 32 bits, BigInteger 64; anything
+    # else fails in the driver (OverflowError, DataError) as a 500
+    bound = 2 ** 63 if isinstance(column.type, BigInteger) else 2 ** 31
+    return -bound <= value < bound
+
+def cursor_value_valid(column, value):
+    # a cursor value is compared with its sort column in SQL, so it must be of
+    # the column's type: a str against an int column matches nothing on SQLite
+    # and is an error on Postgres
+    if isinstance(column.type, Integer):
+        return isinstance(value, int) and not isinstance(value, bool) and integer_in_range(column, value)
+    return isinstance(value, column.type.python_type)
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    # the cursor is opaque for the client, anything we can't read back is a bad request
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (binascii.Error, ValueError):
+        raise APIException("invalid cursor", status_code=400)
+    if not isinstance(values, list) or not values:
+        raise APIException("invalid cursor", status_code=400)
+    return values
+
+def get_page_limit():
+    default_limit = current_app.config["PAGE_DEFAULT_LIMIT"]
+    max_limit = current_app.config["PAGE_MAX_LIMIT"]
+    limit = request.args.get("limit")
+    if limit is None:
+        return default_limit
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise APIException("limit must be an integer", status_code=400)
+    if limit < 1:
+        raise APIException("limit must be greater than 0", status_code=400)
+    return min(limit, max_limit)
+
+def order_by_sort(query, sort):
+    return query.order_by(*[column.desc() if descending else column.asc() for column, descending in sort])
+
+def after_cursor(sort, values):
+    # rows strictly after `values` in the sort order:
+    # (a > va) OR (a = va AND b > vb) OR (a = va AND b = vb AND id > vid) ...
+    clauses = []
+    for position, (column, descending) in enumerate(sort):
+        equal = [previous == values[index] for index, (previous, _) in enumerate(sort[:position])]
+        beyond = column < values[position] if descending else column > values[position]
+        clauses.append(and_(*equal, beyond))
+    return or_(*clauses)
+
+def paginate(query, sort):
+    # keyset pagination on the sort keys (the primary key by default): every
+    # page is an index range scan no matter how deep the client goes, unlike OFFSET
+    limit = get_page_limit()
+    after = request.args.get("after")
+    if after is not None:
+        values = decode_cursor(after)
+        if len(values) != len(sort) or not all(
+                cursor_value_valid(column, value) for (column, descending), value in zip(sort, values)):
+            raise APIException("invalid cursor", status_code=400)
+        query = query.filter(after_cursor(sort, values))
+
+    items = order_by_sort(query, sort).limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor([getattr(items[-1], column.key) for column, descending in sort])
+    return items, next_cursor
+
+def get_fields(model):
+    fields = request.args.get("fields")
+    if fields is None:
+        return None
+    columns = [column.name for column in model.__table__.columns]
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in columns]
+    if unknown:
+        raise APIException("unknown fields: %s" % ", ".join(unknown), status_code=400)
+    # the id always comes back, the pagination cursor is built from it
+    return ["id"] + [name for name in dict.fromkeys(names) if name != "id"]
+
+def select_fields(model, sort=()):
+    # with ?fields= only those columns are selected and rows come back as
+    # tuples, skipping the ORM identity map and the full serialize()
+    fields = get_fields(model)
+    if fields is None:
+        return model.query, serializer_for(model)
+    columns = [getattr(model, name) for name in fields]
+    # sort columns the client didn't ask for are selected after the requested
+    # ones: the cursor needs them, the serializer only reads the first columns
+    extra = [column for column, descending in sort if column.key not in fields]
+    return model.query.with_entities(*columns, *extra), serializer_for(model, fields, tuples=True)
+
+def flag_arg(name):
+    return request.args.get(name, "").lower() in ("1", "true", "yes")
+
+def wants_stream():
+    if flag_arg("stream"):
+        return True
+    best = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+    return best == "application/x-ndjson"
+
+def stream_ndjson(query, sort, serialize):
+    # rows are fetched from a server side cursor in batches and written out as
+    # they arrive, so memory stays flat no matter how big the table is
+    batch_size = current_app.config["STREAM_BATCH_SIZE"]
+    rows = order_by_sort(query, sort).yield_per(batch_size)
+
+    def generate():
+        dumps = current_app.json.dumps
+        chunk = []
+        for item in rows:
+            chunk.append(dumps(serialize(item)))
+            if len(chunk) >= batch_size:
+                yield "\n".join(chunk) + "\n"
+                chunk = []
+        if chunk:
+            yield "\n".join(chunk) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
     return len(defaults) >= len(arguments)
 
 def generate_sitemap(app):
-    links = ['/admin/']
+    links = ['/admin/'] if 'admin' in app.blueprints else []
     for rule in app.url_map.iter_rules():
         # Filter out rules we can't navigate to in a browser
         # and rules that require parameters
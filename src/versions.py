@@ -0,0 +1,85 @@
+"""
+Per-table version counters stored in the database and the conditional GET
+(ETag / If-None-Match) built on top of them
+"""
+import hashlib
+from functools import wraps
+from itertools import chain
+from flask import request, make_response
+from sqlalchemy import event, update, insert
+from models import db, TableVersion
+from compression import etag_variants
+
+def bump_versions(session, tables):
+    # runs inside the writing transaction so the version moves forward
+    # exactly when the data does, for every worker reading the table; once
+    # per table and transaction is enough however many statements wrote to it
+    bumped = session.info.setdefault("bumped_versions", set())
+    tables = set(tables) - bumped
+    if not tables:
+        return
+    bumped.update(tables)
+    table = TableVersion.__table__
+    connection = session.connection()
+    for name in sorted(tables):
+        result = connection.execute(
+            update(table).where(table.c.name == name).values(version=table.c.version + 1)
+        )
+        if result.rowcount == 0:
+            connection.execute(insert(table).values(name=name, version=1))
+
+def setup_table_versions(db):
+
+    @event.listens_for(db.session, "after_flush")
+    def after_flush(session, flush_context):
+        tables = {item.__tablename__ for item in chain(session.new, session.dirty, session.deleted)}
+        tables.discard(TableVersion.__tablename__)
+        if tables:
+            bump_versions(session, tables)
+
+    @event.listens_for(db.session, "do_orm_execute")
+    def after_bulk_statement(orm_execute_state):
+        if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+            mapper = orm_execute_state.bind_mapper
+            if mapper is not None and mapper.class_ is not TableVersion:
+                bump_versions(orm_execute_state.session, {mapper.class_.__tablename__})
+
+    @event.listens_for(db.session, "after_commit")
+    @event.listens_for(db.session, "after_rollback")
+    def reset_bumped(session):
+        session.info.pop("bumped_versions", None)
+
+@event.listens_for(TableVersion.__table__, "after_create")
+def seed_table_versions(target, connection, **kw):
+    # db.create_all() starts from the same rows as the migration does
+    names = sorted(name for name in target.metadata.tables if name != target.name)
+    connection.execute(insert(target), [{"name": name, "version": 1} for name in names])
+
+def table_version(model):
+    version = db.session.query(TableVersion.version).filter_by(name=model.__tablename__).scalar()
+    return version or 0
+
+def make_etag(model, version):
+    # the same table version renders differently depending on the query string
+    # (pages, cursors...) and the negotiated format, so both go into the tag
+    variant = request.full_path + "|" + request.headers.get("Accept", "")
+    digest = hashlib.sha1(variant.encode()).hexdigest()[:16]
+    return "%s-%s-%s" % (model.__tablename__, version, digest)
+
+def etag_by_version(model):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = make_etag(model, table_version(model))
+            for tag in etag_variants(etag):
+                if request.if_none_match.contains(tag):
+                    response = make_response("", 304)
+                    response.set_etag(tag)
+                    return response
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+        return wrapper
+    return decorator
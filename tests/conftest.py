@@ -0,0 +1,83 @@
+"""
+The app reads its configuration from the environment when it is imported, so
+it is pointed at a throwaway SQLite file before that happens. Every test gets
+a freshly created and seeded database and empty caches.
+"""
+import os
+import shutil
+import sys
+import tempfile
+from contextlib import contextmanager
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+DATABASE_DIR = tempfile.mkdtemp(prefix="starwars-tests-")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(DATABASE_DIR, "test.db")
+os.environ.pop("DATABASE_READ_URL", None)
+os.environ["CACHE_BACKEND"] = "memory"
+os.environ["ADMIN_EMAILS"] = "admin@example.com"
+
+from app import app as flask_app, entity_cache, identity_cache, name_index
+from stats import stats_cache
+from models import db, User, Planets, Characters, Starships
+
+SEEDED = 30
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(DATABASE_DIR, ignore_errors=True)
+
+def seed():
+    for index in range(SEEDED):
+        db.session.add(Planets(name="planet %d" % index, climate="arid" if index % 2 else "temperate",
+                               population=index * 1000, orbital_period=index, rotation_period=index, diameter=index))
+        db.session.add(Characters(name="character %d" % index, height=index, mass=index, hair_color="brown",
+                                  eye_color="blue", gender="male" if index % 2 else "female", birth_year="19BBY"))
+        db.session.add(Starships(name="starship %d" % index, manufacturer="Kuat" if index % 3 else "Corellia",
+                                 crew=index, passengers=index, consumables="1 week", cost_in_credits=index * 10))
+    db.session.add(User(first_name="Admin", last_name="Istrator", email="admin@example.com", password="admin"))
+    db.session.add(User(first_name="Luke", last_name="Skywalker", email="luke@example.com", password="luke"))
+    db.session.commit()
+
+@pytest.fixture
+def app():
+    # over budget raises QueryBudgetExceeded instead of only logging it
+    flask_app.config["TESTING"] = True
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed()
+        db.session.remove()
+    for cache in (entity_cache, identity_cache, stats_cache):
+        cache.clear()
+    name_index.clear()
+    yield flask_app
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+@pytest.fixture
+def auth(client):
+    def headers(email="luke@example.com", password="luke"):
+        token = client.post("/login", json={"email": email, "password": password}).get_json()["access_token"]
+        return {"Authorization": "Bearer %s" % token}
+    return headers
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(Engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, "before_cursor_execute", record)
+
+@pytest.fixture
+def queries():
+    return count_queries
@@ -0,0 +1,49 @@
+"""
+Batch get by ids: results in the order asked, unknown ids listed as missing,
+the misses loaded in chunks; malformed or impossible ids are a 400, not a 500.
+"""
+import pytest
+from conftest import SEEDED
+
+@pytest.mark.parametrize("url", ["/planets", "/characters", "/starships"])
+def test_batch_get(client, queries, url):
+    response = client.get(url + "?ids=3,1,999")
+    assert response.status_code == 200
+    assert [item["id"] for item in response.get_json()["results"]] == [3, 1]
+    assert response.get_json()["missing"] == [999]
+
+    with queries() as statements:
+        assert client.post(url, json={"ids": [1, 3]}).status_code == 200
+    assert statements == []
+
+def test_batch_get_chunks(app, client, queries):
+    app.config["BATCH_CHUNK_SIZE"] = 4
+    try:
+        with queries() as statements:
+            response = client.get("/planets?ids=" + ",".join(map(str, range(1, SEEDED + 1))))
+        assert response.status_code == 200
+        assert len(response.get_json()["results"]) == SEEDED
+        assert len(statements) == -(-SEEDED // 4)
+    finally:
+        app.config["BATCH_CHUNK_SIZE"] = 500
+
+def test_batch_get_users(client, auth):
+    assert client.get("/users?ids=1,2").status_code == 401
+    assert client.get("/users?ids=1,2", headers=auth()).status_code == 403
+    response = client.get("/users?ids=2,1", headers=auth("admin@example.com", "admin"))
+    assert response.status_code == 200
+    assert [user["id"] for user in response.get_json()["results"]] == [2, 1]
+
+@pytest.mark.parametrize("url", [
+    "/planets?ids=99999999999999999999999",
+    "/characters?ids=1,-2147483649",
+    "/starships?ids=1,x",
+])
+def test_batch_get_ids_out_of_range(client, url):
+    response = client.get(url)
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "ids must be integers"
+
+def test_batch_post_ids_out_of_range(client):
+    assert client.post("/planets", json={"ids": [1, 2 ** 63]}).status_code == 400
+    assert client.post("/planets", json={"ids": [2 ** 31 - 1]}).get_json()["missing"] == [2 ** 31 - 1]
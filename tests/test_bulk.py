@@ -0,0 +1,26 @@
+"""
+Bulk creation: every item is checked against the column types before the
+insert, the ones that don't fit come back as invalid with the reason.
+"""
+PLANET = {"name": "Dagobah", "climate": "murky", "population": 1, "orbital_period": 341, "rotation_period": 23, "diameter": 8900}
+
+def test_bulk_create_invalid_items(client):
+    items = [
+        dict(PLANET, name=["Hoth"]),
+        dict(PLANET, name="Hoth", population="lots"),
+        dict(PLANET, name="Hoth", moons=2),
+        dict(PLANET, name="Hoth", diameter=2 ** 40),
+        "Hoth",
+        dict(PLANET, name="Hoth", population="3", diameter=7200.0),
+    ]
+    response = client.post("/planets/bulk", json=items)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert [result["status"] for result in body["results"]] == ["invalid"] * 5 + ["created"]
+    assert (body["created"], body["skipped"], body["invalid"]) == (1, 0, 5)
+    assert body["results"][0]["errors"] == {"name": "must be a string"}
+    assert body["results"][1]["errors"] == {"population": "must be an integer"}
+    assert body["results"][2]["errors"] == {"moons": "unknown field"}
+    assert body["results"][3]["errors"] == {"diameter": "out of range"}
+    planet = client.get("/planets/%d" % body["results"][5]["id"]).get_json()["results"]
+    assert (planet["population"], planet["diameter"]) == (3, 7200)
@@ -0,0 +1,61 @@
+"""
+Response compression: the encoding is negotiated with Accept-Encoding, so
+every response of a compressed route, 304s included, varies on it. Every
+encoding, streamed or not, decodes back to the uncompressed payload.
+"""
+import gzip
+import pytest
+from compression import ENCODINGS
+
+@pytest.mark.parametrize("url", ["/all_users?limit=1", "/all_planets?limit=1", "/all_characters?limit=1", "/all_starships?limit=1"])
+def test_vary_on_accept_encoding(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    assert "Accept-Encoding" in response.headers["Vary"]
+
+    response = client.get(url, headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    assert "Accept-Encoding" in response.headers["Vary"]
+
+def decompress(encoding, data):
+    if encoding == "zstd":
+        zstandard = pytest.importorskip("zstandard")
+        # the streamed frame doesn't carry its content size, decompressobj
+        # reads it anyway; eof is only set once the frame is finished
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        data = decompressor.decompress(data)
+        assert decompressor.eof
+        return data
+    if encoding == "br":
+        return pytest.importorskip("brotli").decompress(data)
+    return gzip.decompress(data)
+
+@pytest.mark.parametrize("encoding", ["gzip", "br", "zstd"])
+@pytest.mark.parametrize("url", ["/all_planets?limit=20", "/all_planets?stream=1"])
+def test_compressed_body_decodes_to_the_payload(client, encoding, url):
+    if encoding not in ENCODINGS:
+        pytest.skip("%s is not installed" % encoding)
+    plain = client.get(url, headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in plain.headers
+
+    response = client.get(url, headers={"Accept-Encoding": encoding})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == encoding
+    assert response.get_data() != plain.get_data()
+    assert decompress(encoding, response.get_data()) == plain.get_data()
+
+def test_minimum_size(app, client):
+    url = "/all_planets?limit=5"
+    size = len(client.get(url, headers={"Accept-Encoding": "identity"}).get_data())
+    try:
+        app.config["COMPRESS_MIN_SIZE"] = size + 1
+        response = client.get(url, headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in response.headers
+        assert len(response.get_data()) == size
+
+        app.config["COMPRESS_MIN_SIZE"] = size
+        response = client.get(url, headers={"Accept-Encoding": "gzip"})
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert len(gzip.decompress(response.get_data())) == size
+    finally:
+        app.config["COMPRESS_MIN_SIZE"] = 1024
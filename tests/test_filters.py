@@ -0,0 +1,38 @@
+"""
+Filters, sorting and cursors of the catalog collections: anything the client
+can send that doesn't fit the columns is a 400, never a 500 from the driver,
+and a filter that matches nothing is an empty page, not a 404.
+"""
+import pytest
+from utils import encode_cursor
+
+@pytest.mark.parametrize("url", [
+    "/all_planets?population__gt=999999999999999999999",
+    "/all_planets?population__in=1,-99999999999999999999",
+    "/all_characters?height=2147483648",
+    "/all_planets?population=lots",
+])
+def test_filter_values_out_of_the_column(client, url):
+    assert client.get(url).status_code == 400
+
+def test_filter_at_the_column_bounds(client):
+    assert client.get("/all_planets?population__lt=2147483647").status_code == 200
+    assert client.get("/all_planets?population__gt=-2147483648").status_code == 200
+
+@pytest.mark.parametrize("values", [["x", 1], [1, "1"], [True, 1], [2 ** 40, 1], [1.5, 1], [None, 1], [1]])
+def test_tampered_cursor(client, values):
+    response = client.get("/all_planets?sort=population&after=%s" % encode_cursor(values))
+    assert response.status_code == 400
+
+def test_cursor_of_a_string_column(client):
+    first = client.get("/all_planets?sort=name&limit=2").get_json()
+    response = client.get("/all_planets?sort=name&limit=2&after=%s" % first["next_cursor"])
+    assert response.status_code == 200
+    assert client.get("/all_planets?sort=name&after=%s" % encode_cursor([3, 1])).status_code == 400
+
+@pytest.mark.parametrize("url", ["/all_planets?climate=frozen", "/all_characters?height__gt=1000", "/all_starships?crew__in=-1,-2"])
+def test_filter_matching_nothing(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.get_json()["results"] == []
+    assert response.get_json()["next_cursor"] is None
@@ -0,0 +1,50 @@
+"""
+Samples of several gunicorn workers added up through METRICS_DIR, without
+forking: each worker is a snapshot file written as Metrics.flush would.
+"""
+import json
+import os
+import pytest
+from metrics import Metrics, merge, fold_exited
+
+DEAD_PID = 2 ** 22 + 1  # above the default pid_max, never a live process
+
+def write_snapshot(directory, pid, requests, in_progress):
+    snapshot = {
+        "pid": pid,
+        "counters": [["http_requests_total", [["endpoint", "index"]], requests]],
+        "histograms": [["db_queries_per_request", [["endpoint", "index"]], [requests] + [0] * 9 + [0.0]]],
+        "gauges": [["http_requests_in_progress", [], in_progress]],
+        "collected": [],
+    }
+    with open(os.path.join(directory, "metrics-%d-1.json" % pid), "w") as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+
+@pytest.fixture
+def worker_metrics(tmp_path):
+    metrics = Metrics()
+    metrics.directory = str(tmp_path)
+    return metrics
+
+def totals(metrics):
+    samples, types, helps = merge(metrics.snapshots())
+    return (samples[("http_requests_total", (("endpoint", "index"),))],
+            samples[("db_queries_per_request_count", (("endpoint", "index"),))],
+            samples[("http_requests_in_progress", ())])
+
+def test_exited_workers_are_folded(tmp_path, worker_metrics):
+    write_snapshot(tmp_path, DEAD_PID, 3, 1)
+    write_snapshot(tmp_path, DEAD_PID + 1, 4, 1)
+    fold_exited(str(tmp_path), DEAD_PID)
+    fold_exited(str(tmp_path), DEAD_PID + 1)
+
+    assert os.listdir(tmp_path) == ["metrics-exited.json"]
+    # counters keep counting, the gauges of the exited workers are gone
+    assert totals(worker_metrics) == (7, 7, 0)
+
+def test_folded_file_read_before_removal_is_skipped(tmp_path, worker_metrics):
+    write_snapshot(tmp_path, DEAD_PID, 3, 1)
+    fold_exited(str(tmp_path), DEAD_PID)
+    # as if a scrape read the file between the aggregate write and the remove
+    write_snapshot(tmp_path, DEAD_PID, 3, 1)
+    assert totals(worker_metrics) == (3, 3, 0)
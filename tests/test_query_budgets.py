@@ -0,0 +1,179 @@
+"""
+Every route with a @query_budget, run under TESTING so going over budget (or
+repeating a statement) raises QueryBudgetExceeded and fails the test. Warm
+paths, whose budget is the cold worst case, also check they make no query.
+The batch routes are exercised in test_batch.py, under the same budgets.
+"""
+import pytest
+from sqlalchemy import update
+from budget import query_budget, QueryBudgetExceeded
+from models import db, Planets, Favorites
+from conftest import SEEDED
+from app import name_index
+
+PLANET = {"name": "Dagobah", "climate": "murky", "population": 1, "orbital_period": 341, "rotation_period": 23, "diameter": 8900}
+CHARACTER = {"name": "Yoda", "height": 66, "mass": 17, "hair_color": "white", "eye_color": "brown", "gender": "male", "birth_year": "896BBY"}
+STARSHIP = {"name": "Ghost", "manufacturer": "Corellia", "crew": 6, "passengers": 4, "consumables": "1 month", "cost_in_credits": 100}
+
+def test_budget_raises_when_exceeded(app):
+    with app.app_context():
+        with pytest.raises(QueryBudgetExceeded, match="2 queries, budget is 1"):
+            with query_budget(1):
+                Planets.query.filter_by(id=1).first()
+                Planets.query.filter_by(id=2).first()
+        with pytest.raises(QueryBudgetExceeded, match="repeated statements"):
+            with query_budget(5):
+                Planets.query.filter_by(id=1).first()
+                Planets.query.filter_by(id=1).first()
+
+def test_index(client):
+    assert client.get("/").status_code == 200
+
+@pytest.mark.parametrize("url", ["/all_users", "/all_planets", "/all_characters", "/all_starships"])
+def test_collections(client, url):
+    response = client.get(url + "?limit=1")
+    assert response.status_code == 200
+    assert len(response.get_json()["results"]) == 1
+
+    cursor = response.get_json()["next_cursor"]
+    assert client.get(url + "?limit=1&after=%s" % cursor).status_code == 200
+
+    response = client.get(url + "?limit=1", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+
+@pytest.mark.parametrize("url", [
+    "/all_planets?climate=arid&sort=-population",
+    "/all_characters?gender=female&fields=name",
+    "/all_starships?manufacturer=Kuat&sort=crew&limit=5",
+])
+def test_filtered_collections(client, url):
+    assert client.get(url).status_code == 200
+
+def test_stream_collection(client):
+    response = client.get("/all_planets?stream=1")
+    assert response.status_code == 200
+    assert len(response.get_data(as_text=True).splitlines()) == SEEDED
+
+@pytest.mark.parametrize("url", ["/user/1", "/planets/1", "/characters/1", "/starships/1", "/planets/2?fields=name"])
+def test_single_entities(client, queries, url):
+    assert client.get(url).status_code == 200
+    with queries() as statements:
+        assert client.get(url).status_code == 200
+    if "fields" not in url:
+        assert statements == []
+    assert client.get(url.split("?")[0][:-1] + "999").status_code == 404
+
+def test_search(app, client, queries):
+    # cold: the build is added to the budget of the request that ran it
+    response = client.get("/search?q=planet 1")
+    assert response.status_code == 200
+    assert response.get_json()["results"][0]["name"] == "planet 1"
+
+    with queries() as statements:
+        assert client.get("/search?q=lanet").status_code == 200
+    assert statements == []
+
+    # a written row is reloaded, a bulk statement rebuilds the index in the
+    # background while searches keep using the current one
+    client.post("/planet", json=PLANET)
+    assert client.get("/search?q=dagobah").get_json()["results"][0]["name"] == "Dagobah"
+    with app.app_context():
+        db.session.execute(update(Planets).where(Planets.name == "Dagobah").values(name="Degobah"))
+        db.session.commit()
+    with queries() as statements:
+        assert client.get("/search?q=dagobah").get_json()["results"][0]["name"] == "Dagobah"
+        name_index.join()
+    assert len(statements) == 3 + 3  # the rebuild's table versions and scans
+    assert client.get("/search?q=degobah").get_json()["results"][0]["name"] == "Degobah"
+
+    with queries() as statements:
+        assert client.get("/search?q=degobah").status_code == 200
+    assert statements == []
+
+@pytest.mark.parametrize("entity", ["planets", "characters", "starships"])
+def test_stats(client, queries, entity):
+    assert client.get("/stats/%s" % entity).status_code == 200
+    with queries() as statements:
+        assert client.get("/stats/%s" % entity).status_code == 200
+    assert len(statements) == 1  # only the table version
+
+@pytest.mark.parametrize("url", ["/cache-stats", "/metrics", "/pool-stats"])
+def test_operational_routes(client, url):
+    assert client.get(url).status_code == 200
+
+@pytest.mark.parametrize("url, payload", [
+    ("/planets/bulk", PLANET),
+    ("/characters/bulk", CHARACTER),
+    ("/starships/bulk", STARSHIP),
+])
+def test_bulk_create(app, client, url, payload):
+    app.config["BULK_CHUNK_SIZE"] = 7
+    try:
+        items = [dict(payload, name="%s %d" % (payload["name"], index)) for index in range(20)]
+        items.append(dict(payload, name="%s 0" % payload["name"]))
+        response = client.post(url, json=items)
+        assert response.status_code == 200
+        assert response.get_json()["created"] == 20
+        assert response.get_json()["results"][-1]["status"] == "skipped"
+    finally:
+        app.config["BULK_CHUNK_SIZE"] = 1000
+
+@pytest.mark.parametrize("url, payload", [
+    ("/planet", PLANET),
+    ("/character", CHARACTER),
+    ("/user", {"first_name": "Leia", "last_name": "Organa", "email": "leia@example.com", "password": "leia"}),
+])
+def test_create(client, url, payload):
+    assert client.post(url, json=payload).status_code == 200
+    response = client.post(url, json=payload)
+    assert "already" in str(response.get_json())
+
+def test_signup_and_login(client):
+    payload = {"first_name": "Han", "last_name": "Solo", "email": "han@example.com", "password": "han"}
+    assert client.post("/signup", json=payload).status_code == 200
+    assert client.post("/signup", json=payload).status_code == 400
+    assert client.post("/login", json={"email": "han@example.com", "password": "han"}).status_code == 200
+    assert client.post("/login", json={"email": "han@example.com", "password": "x"}).status_code == 401
+
+def test_favorites(app, client, auth):
+    headers = auth()
+    assert client.get("/valid-token", headers=headers).status_code == 200
+    assert client.get("/favorites", headers=headers).status_code == 404
+    for url in ["/favorites/planet/1", "/favorites/planet/1", "/favorites/starship/1", "/favorites/character/1"]:
+        assert client.post(url, headers=headers).status_code == 200
+
+    for url in ["/favorites", "/user/favorites", "/user/favorites?expand=true"]:
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        assert len(response.get_json()["results"]) == 3
+
+    assert client.delete("/favorites/planet/1", json={"user_id": 2, "planets_id": 1}).status_code == 200
+    assert client.delete("/favorites/character/2/1").status_code == 200
+    with app.app_context():
+        favorite_id = Favorites.query.filter_by(user_id=2).one().id
+    assert client.delete("/favorites/%d" % favorite_id, headers=headers).get_json()["msg"] == "ok, its deleted"
+    assert client.delete("/favorites/%d" % favorite_id, headers=headers).get_json()["msg"] == "this favorite does not exist"
+
+def test_update_and_delete(client):
+    assert "does not exist" in client.put("/planet/999", json=PLANET).get_json()["msg"]
+    assert client.delete("/planet", json={"name": "planet 1"}).get_json()["msg"] == "ok, its deleted"
+    assert client.get("/planets/2").status_code == 404
+    assert client.delete("/users").status_code == 200
+
+# routes that were already broken before the query budgets, kept here so they
+# get a budget check once they are fixed
+@pytest.mark.xfail(strict=True, reason="Starships has no model column")
+def test_create_starship(client):
+    assert client.post("/starship", json=dict(STARSHIP, model="x")).status_code == 200
+
+@pytest.mark.xfail(strict=True, reason="User has no name column")
+def test_update_user(client):
+    assert client.put("/user", json={"name": "Luke", "email": "luke@example.com", "password": "x"}).status_code == 200
+
+@pytest.mark.xfail(strict=True, reason="User has no name column")
+def test_delete_user(client):
+    assert client.delete("/user", json={"name": "Luke"}).status_code == 200
+
+@pytest.mark.xfail(strict=True, reason="the planet columns are assigned tuples")
+def test_update_planet(client):
+    assert client.put("/planet/1", json=PLANET).status_code == 200
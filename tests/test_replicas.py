@@ -0,0 +1,76 @@
+"""
+Read replica routing over two SQLite files: the primary is the seeded test
+database, the replica a second file whose only planet has another name, so
+the rows that come back tell which one was read.
+"""
+import os
+import pytest
+from flask import g
+from sqlalchemy import create_engine, insert, select
+from models import db, Planets
+from replicas import on_primary, pinned_identities
+from conftest import DATABASE_DIR, SEEDED
+
+PLANET = {"name": "Dagobah", "climate": "murky", "population": 1, "orbital_period": 341, "rotation_period": 23, "diameter": 8900}
+REPLICA_PLANET = dict(PLANET, name="replica planet")
+
+@pytest.fixture
+def replica(app, monkeypatch):
+    url = "sqlite:///" + os.path.join(DATABASE_DIR, "replica.db")
+    engine = create_engine(url)
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Planets), [REPLICA_PLANET])
+    monkeypatch.setitem(app.config, "SQLALCHEMY_BINDS", {"replica_0": {"url": url}})
+    with app.app_context():
+        db.engines["replica_0"] = engine
+    pinned_identities._local.clear()
+    yield engine
+    with app.app_context():
+        del db.engines["replica_0"]
+    engine.dispose()
+
+def planet_names(client, **kwargs):
+    response = client.get("/all_planets", **kwargs)
+    assert response.status_code == 200
+    return [planet["name"] for planet in response.get_json()["results"]]
+
+def test_reads_go_to_the_replica(replica, client):
+    assert planet_names(client) == ["replica planet"]
+    # projected rows are not cached, they are read where the route reads
+    assert client.get("/planets/1?fields=name").get_json()["results"]["name"] == "replica planet"
+
+def test_writes_and_cache_fills_go_to_the_primary(app, replica, client):
+    assert client.post("/planet", json=PLANET).status_code == 200
+    with replica.connect() as connection:
+        assert connection.scalars(select(Planets.name)).all() == ["replica planet"]
+    with app.app_context():
+        assert Planets.query.filter_by(name="Dagobah").count() == 1
+
+    # what goes into the entity cache is read from the primary
+    assert app.test_client().get("/planets/1").get_json()["results"]["name"] == "planet 0"
+
+def test_on_primary(app, replica):
+    with app.test_request_context("/all_planets"):
+        g.db_read_only = True
+        assert db.session.get(Planets, 1).name == "replica planet"
+        db.session.expunge_all()
+        with on_primary():
+            assert db.session.get(Planets, 1).name == "planet 0"
+        assert g.db_read_only
+        db.session.remove()
+
+def test_sticky_cookie_after_a_write(app, replica, client):
+    assert client.post("/planet", json=PLANET).status_code == 200
+    assert len(planet_names(client)) == SEEDED + 1
+    # another client doesn't carry the cookie
+    assert planet_names(app.test_client()) == ["replica planet"]
+
+def test_sticky_token_without_cookies(app, replica, auth):
+    headers = auth()
+    assert app.test_client().post("/favorites/planet/1", headers=headers).status_code == 200
+    # a bearer-token client that drops cookies still reads its own write
+    assert len(planet_names(app.test_client(), headers=headers)) == SEEDED
+    assert planet_names(app.test_client()) == ["replica planet"]
+    assert planet_names(app.test_client(), headers=auth("admin@example.com", "admin")) == ["replica planet"]
@@ -0,0 +1,100 @@
+"""
+SharedEntityCache over both stores, a memory mapped file and Redis (through
+LocalRedis, the in-process stand-in). Two caches over the same store stand
+for two workers.
+"""
+import importlib.util
+import os
+import types
+import pytest
+from models import Planets, User
+from shared_cache import MmapStore, RedisStore, LocalRedis, SharedEntityCache
+
+@pytest.fixture(params=["shm", "redis"])
+def store_factory(request, tmp_path):
+    # every call is another worker's view of the same store
+    if request.param == "shm":
+        return lambda: MmapStore(str(tmp_path / "cache"), slots=64, slot_size=512)
+    client = LocalRedis()
+    return lambda: RedisStore(client, "cache:test:")
+
+def workers(store_factory, count=2):
+    return [SharedEntityCache(store_factory(), [Planets], private_models=[User]) for _ in range(count)]
+
+def test_invalidation_reaches_every_worker(store_factory):
+    first, second = workers(store_factory)
+    first.set(Planets, 1, {"name": "Tatooine"})
+    first.set(Planets, 2, {"name": "Hoth"})
+    assert second.get(Planets, 1) == {"name": "Tatooine"}
+
+    second.invalidate(Planets, 1)
+    assert first.get(Planets, 1) is None
+    assert first.get(Planets, 2) == {"name": "Hoth"}
+
+    second.invalidate(Planets)  # the whole table
+    assert first.get(Planets, 2) is None
+
+def test_stale_write_loses_the_race(store_factory):
+    reader, writer = workers(store_factory)
+    generation = reader.generation(Planets)
+    # the row is committed and invalidated while the reader was loading it
+    writer.invalidate(Planets, 1)
+    assert reader.set(Planets, 1, {"name": "old"}, generation) == {"name": "old"}
+    assert reader.get(Planets, 1) is None
+    assert writer.get(Planets, 1) is None
+
+    reader.set(Planets, 1, {"name": "new"}, reader.generation(Planets))
+    assert writer.get(Planets, 1) == {"name": "new"}
+
+def test_private_models_share_only_their_invalidation(store_factory):
+    first, second = workers(store_factory)
+    first.set(User, 1, {"email": "luke@example.com", "password": "secret"})
+    assert first.get(User, 1)["password"] == "secret"
+    assert second.get(User, 1) is None  # never written to the store
+
+    second.set(User, 1, {"email": "luke@example.com", "password": "secret"})
+    second.invalidate(User, 1)
+    assert first.get(User, 1) is None
+    assert second.get(User, 1) is None
+
+def test_private_payloads_stay_out_of_the_store():
+    client = LocalRedis()
+    cache = SharedEntityCache(RedisStore(client, "cache:test:"), [Planets], private_models=[User])
+    cache.set(User, 1, {"password": "secret"})
+    assert cache.get(User, 1) == {"password": "secret"}
+    assert not any(b"secret" in value for value, expires in client._data.values())
+
+def test_oversized_payload_is_not_cached(tmp_path):
+    cache = SharedEntityCache(MmapStore(str(tmp_path / "cache"), slots=64, slot_size=256), [Planets])
+    payload = {"name": "x" * 1000}
+    assert cache.set(Planets, 1, payload) == payload
+    assert cache.get(Planets, 1) is None
+    cache.set(Planets, 2, {"name": "small"})
+    assert cache.get(Planets, 2) == {"name": "small"}
+
+def test_epoch_bump_on_start(monkeypatch, store_factory):
+    import app
+    ours, other_host = workers(store_factory)
+    ours.set(Planets, 1, {"name": "cached before the restart"})
+
+    # the master's on_starting hook, with this store behind the app's caches
+    monkeypatch.setenv("WEB_CONCURRENCY", "1")
+    monkeypatch.delenv("METRICS_DIR", raising=False)
+    monkeypatch.setattr(app, "entity_cache", ours)
+    path = os.path.join(os.path.dirname(app.__file__), "gunicorn.conf.py")
+    spec = importlib.util.spec_from_file_location("gunicorn_conf", path)
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    config.on_starting(types.SimpleNamespace(cfg=types.SimpleNamespace(workers=1), log=None))
+
+    assert other_host.get(Planets, 1) is None
+
+def test_deployments_keep_apart_on_one_server():
+    client = LocalRedis()
+    ours = SharedEntityCache(RedisStore(client, "cache:ours:"), [Planets])
+    theirs = SharedEntityCache(RedisStore(client, "cache:theirs:"), [Planets])
+    ours.set(Planets, 1, {"name": "ours"})
+    theirs.set(Planets, 1, {"name": "theirs"})
+    ours.invalidate_models(ours.models)
+    assert ours.get(Planets, 1) is None
+    assert theirs.get(Planets, 1) == {"name": "theirs"}